@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of TemperaturesCheck.check() against stand-in sensors, sudo and smartctl
+executables and a synthetic /sys tree.
+
+Every scenario runs in its own worker process so peak RSS is per scenario. For each run it reports
+wall time, CPU time (the check and its children), peak RSS and how many processes were started.
+
+    python3 bench/bench_check.py --drives 8 64 256 1000 --latency 0.05 --hang 1 --standby 10
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_parse_sensors import load_check, make_fixture
+
+SMARTCTL = r'''#!/bin/sh
+# Stand-in for `smartctl --json [-n standby] -A /dev/sdX`, driven by BENCH_* environment variables
+echo smartctl >> "$BENCH_PROCESS_LOG"
+for device; do :; done
+name=${device##*/}
+case " $BENCH_HANG " in *" $name "*) exec sleep 3600;; esac
+case " $* " in *" -n standby "*)
+    case " $BENCH_STANDBY " in *" $name "*)
+        echo '{"smartctl": {"exit_status": 2, "messages": [{"string": "Device is in STANDBY mode, exit(2)", "severity": "information"}]}}'
+        exit 2;;
+    esac;;
+esac
+[ "$BENCH_LATENCY" = 0 ] || sleep "$BENCH_LATENCY"
+echo '{"device": {"name": "'"$device"'", "protocol": "ATA"}, "ata_smart_attributes": {"revision": 10, "table": [{"id": 194, "name": "Temperature_Celsius", "value": 36, "raw": {"value": 36, "string": "36"}}]}, "temperature": {"current": 36, "drive_trip": 60}}'
+'''
+
+SUDO = r'''#!/bin/sh
+echo sudo >> "$BENCH_PROCESS_LOG"
+exec "$@"
+'''
+
+SENSORS = r'''#!/bin/sh
+echo sensors >> "$BENCH_PROCESS_LOG"
+case "$1" in -j) exec cat "$BENCH_SENSORS_JSON";; esac
+exec cat "$BENCH_SENSORS_TEXT"
+'''
+
+
+def drive_name(index):
+    """
+    Returns the kernel name of the index-th SCSI disk: sda..sdz, sdaa..sdzz, sdaaa...
+    """
+    name = ''
+    index += 1
+    while index:
+        index, letter = divmod(index - 1, 26)
+        name = chr(ord('a') + letter) + name
+    return 'sd' + name
+
+
+def write(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb' if isinstance(value, bytes) else 'w') as f:
+        f.write(value)
+
+
+def build_tree(root, drives, sockets):
+    """
+    Creates sys/class/hwmon, sys/class/thermal and sys/block under root for `drives` SAS disks
+    behind one HBA and `sockets` EPYC packages.
+    """
+    sys_root = os.path.join(root, 'sys')
+    for subsystem in ('pci', 'scsi'):
+        os.makedirs(os.path.join(sys_root, 'bus', subsystem))
+
+    hwmon = 0
+    for socket_id in range(sockets):
+        for die in range(8):
+            pci = f"0000:00:{0x18 + socket_id * 8 + die:02x}.3"
+            device = os.path.join(sys_root, 'devices', 'pci0000:00', pci)
+            os.makedirs(device)
+            os.symlink(os.path.join(sys_root, 'bus', 'pci'), os.path.join(device, 'subsystem'))
+            hwmon_dir = os.path.join(sys_root, 'class', 'hwmon', f"hwmon{hwmon}")
+            write(os.path.join(hwmon_dir, 'name'), 'k10temp\n')
+            os.symlink(device, os.path.join(hwmon_dir, 'device'))
+            write(os.path.join(hwmon_dir, 'temp1_input'), f"{45000 + die * 500}\n")
+            write(os.path.join(hwmon_dir, 'temp1_label'), 'Tctl\n')
+            for ccd in range(1, 5):
+                write(os.path.join(hwmon_dir, f"temp{ccd + 2}_input"), f"{44000 + ccd * 250}\n")
+                write(os.path.join(hwmon_dir, f"temp{ccd + 2}_label"), f"Tccd{ccd}\n")
+            hwmon += 1
+    write(os.path.join(sys_root, 'class', 'thermal', 'thermal_zone0', 'temp'), '27800\n')
+
+    names = []
+    for index in range(drives):
+        name = drive_name(index)
+        names.append(name)
+        scsi = f"0:0:{index}:0"
+        block = os.path.join('devices', 'pci0000:40', '0000:40:01.1', '0000:41:00.0', 'host0', f"port-0:{index}", f"end_device-0:{index}", f"target0:0:{index}", scsi, 'block', name)
+        device = os.path.join(sys_root, os.path.dirname(os.path.dirname(block)))
+        write(os.path.join(device, 'model'), 'ST16000NM001G   \n')
+        write(os.path.join(device, 'wwid'), f"naa.5000c500{index:08x}\n")
+        write(os.path.join(device, 'vpd_pg80'), b'\x00\x80\x00\x08' + f"ZL{index:06d}".encode())
+        write(os.path.join(sys_root, block, 'queue', 'rotational'), '1\n')
+        os.symlink(device, os.path.join(sys_root, block, 'device'))
+        os.makedirs(os.path.join(sys_root, 'block'), exist_ok=True)
+        os.symlink(os.path.join('..', block), os.path.join(sys_root, 'block', name))
+    return sys_root, names
+
+
+def install_stand_ins(root, sockets):
+    bin_dir = os.path.join(root, 'bin')
+    for name, script in (('smartctl', SMARTCTL), ('sudo', SUDO), ('sensors', SENSORS)):
+        write(os.path.join(bin_dir, name), script)
+        os.chmod(os.path.join(bin_dir, name), 0o755)
+    text, json_text = make_fixture(sockets, 0)
+    write(os.path.join(root, 'sensors.txt'), text)
+    write(os.path.join(root, 'sensors.json'), json_text)
+    return bin_dir
+
+
+def worker(args):
+    """
+    Runs one scenario in this process and prints its runs as JSON.
+    """
+    root = tempfile.mkdtemp(prefix='bench-temperatures-')
+    try:
+        sys_root, names = build_tree(root, args.drives, args.sockets)
+        bin_dir = install_stand_ins(root, args.sockets)
+        process_log = os.path.join(root, 'processes.log')
+        write(process_log, '')
+        os.environ.update({
+            'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+            'BENCH_PROCESS_LOG': process_log,
+            'BENCH_LATENCY': str(args.latency),
+            'BENCH_HANG': ' '.join(names[:args.hang]),
+            'BENCH_STANDBY': ' '.join(names[args.hang:args.hang + args.standby]),
+            'BENCH_SENSORS_TEXT': os.path.join(root, 'sensors.txt'),
+            'BENCH_SENSORS_JSON': os.path.join(root, 'sensors.json'),
+        })
+
+        check_module = load_check()
+        check = check_module.TemperaturesCheck('temperatures', {}, {}, [{
+            'log_file': os.path.join(root, 'temp_check.log'),
+            'log_level': 'WARNING',
+            'sensors_source': args.sensors_source,
+            'sensors_path': os.path.join(bin_dir, 'sensors'),
+            'hwmon_path': os.path.join(sys_root, 'class', 'hwmon'),
+            'thermal_path': os.path.join(sys_root, 'class', 'thermal'),
+            'sys_block_path': os.path.join(sys_root, 'block'),
+            'skip_standby_drives': args.standby > 0,
+            'smartctl_concurrency': args.concurrency,
+            'smartctl_timeout': args.timeout,
+            'smartctl_total_timeout': args.total_timeout,
+        }])
+        metrics = []
+        check.gauge = lambda metric, value, tags=None: metrics.append(metric)
+
+        runs = []
+        for _ in range(args.runs):
+            del metrics[:]
+            with open(process_log) as f:
+                processes_before = sum(1 for _ in f)
+            self_before = resource.getrusage(resource.RUSAGE_SELF)
+            children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            started = time.perf_counter()
+            check.check({})
+            wall = time.perf_counter() - started
+            self_after = resource.getrusage(resource.RUSAGE_SELF)
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            with open(process_log) as f:
+                processes = sum(1 for _ in f) - processes_before
+            runs.append({
+                'wall': wall,
+                'cpu': (self_after.ru_utime + self_after.ru_stime - self_before.ru_utime - self_before.ru_stime),
+                'children_cpu': (children_after.ru_utime + children_after.ru_stime - children_before.ru_utime - children_before.ru_stime),
+                'peak_rss_kb': self_after.ru_maxrss,
+                'processes': processes,
+                'metrics': len(metrics),
+            })
+        check.cancel()
+        print(json.dumps(runs))
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--drives', type=int, nargs='+', default=[8, 64, 256, 1000], help='fleet sizes to run')
+    parser.add_argument('--sockets', type=int, default=2, help='CPU packages, each reporting 8 k10temp chips')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each smartctl takes')
+    parser.add_argument('--hang', type=int, default=0, help='drives whose smartctl never returns')
+    parser.add_argument('--standby', type=int, default=0, help='spun-down drives, enables skip_standby_drives')
+    parser.add_argument('--sensors-source', choices=('sysfs', 'sensors'), default='sysfs')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--total-timeout', type=float, default=30)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as JSON, e.g. to keep as a baseline')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.drives = args.drives[0]
+        worker(args)
+        return
+
+    results = {}
+    for drives in args.drives:
+        command = [sys.executable, os.path.abspath(__file__), '--worker', '--drives', str(drives)]
+        for option in ('sockets', 'latency', 'hang', 'standby', 'sensors_source', 'concurrency', 'timeout', 'total_timeout', 'runs'):
+            command += ['--' + option.replace('_', '-'), str(getattr(args, option))]
+        results[drives] = json.loads(subprocess.check_output(command, universal_newlines=True))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'drives':>6} {'run':>3} {'wall s':>8} {'cpu s':>7} {'child cpu s':>11} {'peak rss MB':>11} {'processes':>9} {'metrics':>7}")
+    for drives, runs in results.items():
+        for number, run in enumerate(runs, 1):
+            print(f"{drives:>6} {number:>3} {run['wall']:8.3f} {run['cpu']:7.3f} {run['children_cpu']:11.3f} {run['peak_rss_kb'] / 1024:11.1f} {run['processes']:>9} {run['metrics']:>7}")
+
+
+if __name__ == '__main__':
+    main()
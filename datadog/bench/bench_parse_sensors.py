@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of parse_sensors() against the original block/line parser on large multi-socket
+`sensors` output.
+
+    python3 bench/bench_parse_sensors.py [--sockets 2] [--nvme 24] [--repeat 2000]
+"""
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import os
+import re
+import timeit
+
+CHECK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'checks.d', 'temperatures.py')
+
+
+def load_check():
+    loader = importlib.machinery.SourceFileLoader('temperatures', CHECK_PATH)
+    spec = importlib.util.spec_from_loader('temperatures', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def legacy_parse_sensors(data):
+    """
+    The parser the check shipped with before the single-pass rewrite, kept as the baseline.
+    """
+    sensors = {}
+    for block in data.strip().split('\n\n'):
+        lines = block.strip().split('\n')
+        sensor_name = lines[0].strip()
+        sensors[sensor_name] = []
+        for i, line in enumerate(lines[1:]):
+            line = line.strip()
+            if not line:
+                continue
+            temp_match = re.search(r'(.+?):\s*\+?(-?\d+\.\d+)\s?°?C', line)
+            if temp_match:
+                sensor_data = {'component': temp_match.group(1).strip(), 'temp': float(temp_match.group(2))}
+                full_line = line
+                if i + 2 < len(lines):
+                    full_line += lines[i + 2].strip()
+                for key in ('low', 'high', 'crit'):
+                    match = re.search(key + r'\s*=\s*\+?(-?\d+\.\d+)', full_line)
+                    if match:
+                        sensor_data[key] = float(match.group(1))
+                sensors[sensor_name].append(sensor_data)
+    return sensors
+
+
+def make_fixture(sockets, nvme):
+    """
+    Builds matching text and `sensors -j` output for `sockets` EPYC packages (4 CCD k10temp blocks
+    each, the way Zen 2 with eight dies per socket reports them) and `nvme` NVMe drives.
+    """
+    text = []
+    data = {}
+    for socket in range(sockets):
+        for die in range(8):
+            name = f"k10temp-pci-{0xc3 + (socket * 8 + die) * 8:04x}"
+            components = [('Tctl', 45.0 + die)] + [(f"Tccd{ccd}", 44.0 + ccd) for ccd in range(1, 5)]
+            text.append(f"{name}\nAdapter: PCI adapter\n" + ''.join(f"{label}:{' ' * (14 - len(label))}+{value:.1f}°C  \n" for label, value in components))
+            data[name] = {'Adapter': 'PCI adapter'}
+            data[name].update({label: {f"temp{i + 1}_input": value} for i, (label, value) in enumerate(components)})
+    for drive in range(nvme):
+        name = f"nvme-pci-{0x4100 + drive * 0x100:04x}"
+        text.append(
+            f"{name}\nAdapter: PCI adapter\n"
+            "Composite:    +40.9°C  (low  = -273.1°C, high = +79.8°C)\n"
+            "                       (crit = +82.8°C)\n"
+            "Sensor 1:     +40.9°C  (low  = -273.1°C, high = +65261.8°C)\n"
+            "Sensor 2:     +48.9°C  (low  = -273.1°C, high = +65261.8°C)\n"
+        )
+        data[name] = {
+            'Adapter': 'PCI adapter',
+            'Composite': {'temp1_input': 40.9, 'temp1_max': 79.8, 'temp1_min': -273.1, 'temp1_crit': 82.8, 'temp1_alarm': 0.0},
+            'Sensor 1': {'temp2_input': 40.9, 'temp2_max': 65261.8, 'temp2_min': -273.1},
+            'Sensor 2': {'temp3_input': 48.9, 'temp3_max': 65261.8, 'temp3_min': -273.1},
+        }
+    return '\n'.join(text), json.dumps(data, indent=3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sockets', type=int, default=2)
+    parser.add_argument('--nvme', type=int, default=24)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    check = load_check()
+    text, json_text = make_fixture(args.sockets, args.nvme)
+    assert check.parse_sensors(text) == legacy_parse_sensors(text)
+    assert check.parse_sensors_json(json_text) == check.parse_sensors(text)
+
+    results = [
+        ('legacy parse_sensors', lambda: legacy_parse_sensors(text)),
+        ('parse_sensors', lambda: check.parse_sensors(text)),
+        ('parse_sensors_json', lambda: check.parse_sensors_json(json_text)),
+    ]
+    print(f"{args.sockets} sockets, {args.nvme} NVMe drives, {len(text.splitlines())} lines, best of 5 x {args.repeat}")
+    baseline = None
+    for name, parse in results:
+        seconds = min(timeit.repeat(parse, number=args.repeat, repeat=5)) / args.repeat
+        baseline = baseline or seconds
+        print(f"{name:24} {seconds * 1e6:9.1f} us  {baseline / seconds:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
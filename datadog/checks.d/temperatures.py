@@ -1,8 +1,23 @@
+import argparse
+import errno
+import glob
+import hashlib
 import json
 import logging
 import os
+import random
 import re
+import socket
 import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from datadog_checks.base import AgentCheck
@@ -12,6 +27,8 @@ except ImportError:
     except ImportError:
         # Define a dummy AgentCheck for testing purposes if not found
         class AgentCheck:
+            def __init__(self, *args, **kwargs):
+                pass
             def gauge(self, metric, value, tags=None):
                 pass
             def log(self, *args, **kwargs):
@@ -28,89 +45,288 @@ except ImportError:
 __version__ = "1.0.0"
 
 
+# "Tctl:         +44.5°C  " or "Composite:    +30.9°C  (low  = -273.1°C, high = +79.8°C)"
+SENSOR_TEMP_PATTERN = re.compile(r'(.+?):\s*\+?(-?\d+\.\d+)\s?°?C')
+SENSOR_LIMIT_PATTERN = re.compile(r'(low|high|crit)\s*=\s*\+?(-?\d+\.\d+)')
+# Subfeatures of `sensors -j` output, e.g. "temp1_input", "temp1_crit"
+SENSOR_JSON_KEY_PATTERN = re.compile(r'^temp\d+_(input|min|max|crit)$')
+SENSOR_JSON_KEYS = {'input': 'temp', 'min': 'low', 'max': 'high', 'crit': 'crit'}
+
+
 def parse_sensors(data):
     """
     Parses the sensor data and returns a dictionary of sensor names and temperatures.
+
+    The output is scanned once: a blank line starts a new chip, and limits on an indented
+    continuation line such as "(crit = +82.8°C)" belong to the temperature line above it.
     """
     sensors = {}
-    sensor_blocks = data.strip().split('\n\n')
-    log = logging.getLogger(__name__)
-    log.debug("Sensor blocks: %s", sensor_blocks)
-    for block in sensor_blocks:
-        log.debug("Processing block: %s", block)
-        lines = block.strip().split('\n')
-        sensor_name = lines[0].strip()
-        log.debug("Sensor name: %s", sensor_name)
-        sensors[sensor_name] = []
-        for i, line in enumerate(lines[1:]):
-            log.debug("Processing line: %s", line)
-            line = line.strip()
-            if not line:
-                continue
+    readings = None
+    sensor_data = None
+    for line in data.splitlines():
+        line = line.strip()
+        if not line:
+            readings = None
+            continue
+        if readings is None:
+            readings = sensors[line] = []
+            sensor_data = None
+            continue
 
-            temp_match = re.search(r'(.+?):\s*\+?(-?\d+\.\d+)\s?°?C', line)
-            if temp_match:
-                log.debug("Temp match found: %s", temp_match.groups())
-                component = temp_match.group(1).strip()
-                temperature = float(temp_match.group(2))                
-                sensor_data = {'component': component, 'temp': temperature}
-                
-                full_line = line
-                if i + 2 < len(lines):
-                    full_line += lines[i + 2].strip()
-
-                low_match = re.search(r'low\s*=\s*\+?(-?\d+\.\d+)', full_line)
-                high_match = re.search(r'high\s*=\s*\+?(-?\d+\.\d+)', full_line)
-                crit_match = re.search(r'crit\s*=\s*\+?(-?\d+\.\d+)', full_line)
-
-                if low_match:
-                    sensor_data['low'] = float(low_match.group(1))
-                if high_match:
-                    sensor_data['high'] = float(high_match.group(1))
-                if crit_match:
-                    sensor_data['crit'] = float(crit_match.group(1))
-
-                sensors[sensor_name].append(sensor_data)
+        temp_match = SENSOR_TEMP_PATTERN.match(line)
+        if temp_match:
+            sensor_data = {'component': temp_match.group(1).strip(), 'temp': float(temp_match.group(2))}
+            readings.append(sensor_data)
+            limits = line[temp_match.end():]
+        elif sensor_data is not None and line.startswith('('):
+            limits = line
+        else:
+            sensor_data = None
+            continue
+        for key, value in SENSOR_LIMIT_PATTERN.findall(limits):
+            sensor_data.setdefault(key, float(value))
     return sensors
 
 
-def get_drive_temperatures(log):
+def parse_sensors_json(data):
+    """
+    Parses `sensors -j` output into the same structure as parse_sensors().
+    """
+    sensors = {}
+    for sensor_name, features in json.loads(data).items():
+        readings = sensors[sensor_name] = []
+        for component, subfeatures in features.items():
+            if not isinstance(subfeatures, dict):
+                continue
+            sensor_data = {'component': component}
+            for key, value in subfeatures.items():
+                match = SENSOR_JSON_KEY_PATTERN.match(key)
+                if match:
+                    sensor_data[SENSOR_JSON_KEYS[match.group(1)]] = float(value)
+            if 'temp' in sensor_data:
+                # Keep the key order parse_sensors() produces
+                readings.append({key: sensor_data[key] for key in ('component', 'temp', 'low', 'high', 'crit') if key in sensor_data})
+    return sensors
+
+
+def _is_standby(smart_data):
+    """
+    Tells whether smartctl skipped the device because `-n standby` found it spun down.
+    """
+    power_mode = smart_data.get('power_mode', '')
+    if isinstance(power_mode, str) and power_mode.upper() in ('STANDBY', 'SLEEP'):
+        return True
+    for message in smart_data.get('smartctl', {}).get('messages', []):
+        text = message.get('string', '').upper()
+        if 'STANDBY' in text or 'SLEEP' in text:
+            return True
+    return False
+
+
+# Seconds a timed out smartctl gets to exit after SIGTERM before it is killed
+SMARTCTL_TERMINATE_GRACE = 2
+
+
+def _run_smartctl(command, timeout):
+    """
+    Runs a single smartctl command and returns (returncode, stdout, stderr).
+
+    On expiry the process is sent SIGTERM, which sudo relays to smartctl, then SIGKILL, and
+    subprocess.TimeoutExpired is raised.
+    """
+    process = subprocess.Popen(command, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.terminate()
+        try:
+            process.communicate(timeout=SMARTCTL_TERMINATE_GRACE)
+        except subprocess.TimeoutExpired:
+            # Don't wait on the pipes here, an orphaned smartctl may still hold them open
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            process.stderr.close()
+        raise
+    return process.returncode, stdout, stderr
+
+
+def new_collection_stats():
+    """
+    Returns the counters a collection fills in: forks and errors, durations per phase and per drive in seconds.
+    """
+    return {'forks': 0, 'errors': 0, 'durations': {}, 'drive_durations': {}}
+
+
+class _LazyJson(object):
+    """
+    Defers json.dumps() of a debug payload until a log record is actually formatted.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, indent=2)
+
+
+class PayloadSampler(logging.Filter):
+    """
+    Lets through only a `rate` fraction of records logged with extra=PAYLOAD, such as full smartctl output.
+    """
+
+    def __init__(self, rate):
+        super(PayloadSampler, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, 'payload', False) or random.random() < self.rate
+
+
+PAYLOAD = {'payload': True}
+
+
+def _poll_smartctl(log, drive_paths, skip_standby, concurrency, timeout, total_timeout, stats):
+    """
+    Runs `sudo smartctl` on every drive through a bounded pool and returns {device: (returncode, stdout, stderr, duration)}.
+
+    Drives that timed out have a returncode of None; drives smartctl could not be started for are left out.
+    """
+    results = {}
+    futures = {}
+    deadline = time.monotonic() + total_timeout if total_timeout else None
+
+    def poll(command):
+        drive_timeout = timeout
+        if deadline is not None:
+            drive_timeout = min(timeout, deadline - time.monotonic())
+            if drive_timeout <= 0:
+                raise subprocess.TimeoutExpired(command, 0)
+        started = time.monotonic()
+        try:
+            return _run_smartctl(command, drive_timeout) + (time.monotonic() - started,)
+        except subprocess.TimeoutExpired:
+            stats['drive_durations'][os.path.basename(command[-1])] = time.monotonic() - started
+            raise
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for drive_path in drive_paths:
+            command = ['sudo', 'smartctl', '--json', '-A', drive_path]
+            if skip_standby:
+                command[3:3] = ['-n', 'standby']
+            futures[os.path.basename(drive_path)] = executor.submit(poll, command)
+
+    for device, future in futures.items():
+        try:
+            results[device] = future.result()
+            stats['forks'] += 1
+        except subprocess.TimeoutExpired:
+            # Drives skipped because of total_timeout were never started
+            if device in stats['drive_durations']:
+                stats['forks'] += 1
+            results[device] = (None, '', '', stats['drive_durations'].get(device))
+        except OSError as e:
+            stats['errors'] += 1
+            log.warning(f"Could not run smartctl for /dev/{device}: {e}")
+    return results
+
+
+def _query_smartctl_helper(log, helper_socket, drive_paths, skip_standby, concurrency, timeout, total_timeout):
+    """
+    Asks the privileged dd-temperatures-helper to run smartctl on every drive in one batched request.
+
+    Returns the same {device: (returncode, stdout, stderr, duration)} mapping as _poll_smartctl(), or None if the
+    helper could not be reached.
+    """
+    request = {
+        'devices': [os.path.basename(drive_path) for drive_path in drive_paths],
+        'skip_standby': skip_standby,
+        'concurrency': concurrency,
+        'timeout': timeout,
+        'total_timeout': total_timeout,
+    }
+    # The helper bounds its own run time the same way, leave it some slack to answer
+    budget = total_timeout or timeout * -(-len(drive_paths) // max(1, concurrency))
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(budget + SMARTCTL_TERMINATE_GRACE + timeout)
+            sock.connect(helper_socket)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            sock.shutdown(socket.SHUT_WR)
+            response = b''.join(iter(lambda: sock.recv(65536), b''))
+        drives = json.loads(response)['drives']
+    except (OSError, ValueError, KeyError) as e:
+        log.warning(f"Could not query smartctl helper on {helper_socket}: {e}")
+        return None
+    return {device: (result.get('returncode'), result.get('stdout', ''), result.get('stderr', ''), result.get('duration')) for device, result in drives.items()}
+
+
+def get_drive_temperatures(log, devices=None, skip_standby=False, cache=None, concurrency=8, timeout=10, total_timeout=None, helper_socket=None, stats=None):
     """
-    Finds all hard drives, runs smartctl on them in parallel with JSON output, and returns their temperatures.
+    Runs smartctl on the given drives (or every disk in /sys/block) in parallel with JSON output, and returns their temperatures.
+
+    With skip_standby, smartctl is run with `-n standby` so spun-down drives are not woken up. Their last
+    reading from cache ({device: (timestamp, values)}) is returned instead, with 'power_state' set to
+    'standby'. Every reading carries 'read_at', the time.time() it was taken at.
+
+    At most `concurrency` smartctl processes run at once, each is killed after `timeout` seconds, and
+    drives not started within `total_timeout` seconds are skipped. Drives that time out are returned
+    as {'timeout': True} rather than blocking the check.
+
+    With helper_socket, smartctl is run by the privileged helper listening on that Unix socket instead
+    of through one sudo per drive; sudo is only used if the helper cannot be reached.
+
+    Forks, errors and the time spent on each drive are added to `stats` (see new_collection_stats()).
     """
     log.info("Starting hard drive temperature collection.")
     drive_temps = {}
-    processes = {}
-    drive_paths = [os.path.join('/dev', device) for device in sorted(os.listdir('/dev')) if re.match(r'^sd[a-z]$', device)]
+    if stats is None:
+        stats = new_collection_stats()
+    if devices is None:
+        devices = BlockDeviceIndex(log).refresh()
+    drive_paths = [os.path.join('/dev', device) for device in sorted(devices)]
     log.info(f"Found {len(drive_paths)} drives to check.")
-    log.debug(f"Drive paths: {drive_paths}")
+    log.debug("Drive paths: %s", drive_paths)
 
-    for drive_path in drive_paths:
-        device = os.path.basename(drive_path)
-        try:
-            # Start smartctl process for each drive in parallel
-            processes[device] = subprocess.Popen(['sudo', 'smartctl', '--json', '-A', drive_path], universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except (subprocess.CalledProcessError, FileNotFoundError) as e:
-            log.warning(f"Could not run smartctl for {drive_path}: {e}")
+    results = None
+    if helper_socket:
+        results = _query_smartctl_helper(log, helper_socket, drive_paths, skip_standby, concurrency, timeout, total_timeout)
+    if results is None:
+        results = _poll_smartctl(log, drive_paths, skip_standby, concurrency, timeout, total_timeout, stats)
 
-    for device, process in processes.items():
+    for device, (returncode, stdout, stderr, duration) in results.items():
         drive_path = os.path.join('/dev', device)
+        if duration is not None:
+            stats['drive_durations'][device] = duration
+        if returncode is None:
+            stats['errors'] += 1
+            log.warning(f"smartctl for {drive_path} timed out")
+            drive_temps[device] = {'timeout': True}
+            continue
+
         try:
-            # Wait for the process to complete and get the output
-            stdout, stderr = process.communicate()
-            if process.returncode != 0:
-                log.warning(f"smartctl for {drive_path} returned non-zero exit code {process.returncode}. Stdout: {stdout.strip()}. Stderr: {stderr.strip()}")
+            if skip_standby and returncode & 2 and _is_standby(json.loads(stdout or '{}')):
+                if cache is not None and device in cache:
+                    timestamp, values = cache[device]
+                    drive_temps[device] = dict(values, power_state='standby', read_at=timestamp)
+                    log.debug("%s is in standby, reusing reading from %s", drive_path, timestamp)
+                else:
+                    log.info(f"{drive_path} is in standby and has no previous reading, skipping")
+                continue
+            if returncode != 0:
+                stats['errors'] += 1
+                log.warning(f"smartctl for {drive_path} returned non-zero exit code {returncode}. Stdout: {stdout.strip()}. Stderr: {stderr.strip()}")
                 continue
 
             # Parse JSON output
             smart_data = json.loads(stdout)
-            log.debug(f"Smart data for {drive_path}: {json.dumps(smart_data, indent=2)}")
-            
+            log.debug("Smart data for %s: %s", drive_path, _LazyJson(smart_data), extra=PAYLOAD)
+
             # Extract current drive temperature and other relevant temps
             drive_temp_values = {}
             # Try to extract temperature using the new helper function first
             current_temp = _extract_temperature_from_smart_data(smart_data, log)
-            log.debug(f"Extracted current_temp for {drive_path}: {current_temp}")
+            log.debug("Extracted current_temp for %s: %s", drive_path, current_temp)
             if current_temp is not None:
                 drive_temp_values['current'] = current_temp
                 # Attempt to get 'crit' from the top-level 'temperature' section if available
@@ -122,15 +338,21 @@ def get_drive_temperatures(log):
                     drive_temp_values['current'] = temp_data['current']
                 if 'drive_trip' in temp_data:
                     drive_temp_values['crit'] = temp_data['drive_trip']
-            log.debug(f"Final drive_temp_values for {drive_path}: {drive_temp_values}")
+            log.debug("Final drive_temp_values for %s: %s", drive_path, drive_temp_values)
 
             if drive_temp_values:
-                drive_temps[device] = drive_temp_values
+                read_at = time.time()
+                drive_temps[device] = dict(drive_temp_values, read_at=read_at)
+                if cache is not None:
+                    cache[device] = (read_at, drive_temp_values)
             else:
+                stats['errors'] += 1
                 log.warning(f"No temperature data found in smartctl JSON output for {drive_path}")
         except json.JSONDecodeError as e:
+            stats['errors'] += 1
             log.warning(f"Could not decode JSON from smartctl output for {drive_path}: {e}")
         except KeyError as e:
+            stats['errors'] += 1
             log.warning(f"Missing expected key in smartctl JSON output for {drive_path}: {e}")
 
     log.info(f"Successfully collected temperatures for {len(drive_temps)} drives.")
@@ -156,128 +378,1387 @@ def _extract_temperature_from_smart_data(smart_data, log):
     log.debug("No temperature found in known locations within smartctl JSON output.")
     return None
 
+
+HWMON_PATH = '/sys/class/hwmon'
+THERMAL_PATH = '/sys/class/thermal'
+CPU_PATH = '/sys/devices/system/cpu'
+
+# Map of hwmon limit attribute suffixes to the keys parse_sensors() produces.
+HWMON_LIMITS = (('min', 'low'), ('max', 'high'), ('crit', 'crit'))
+
+# hwmon drivers reporting the temperature of a whole drive
+DRIVE_HWMON_NAMES = ('drivetemp', 'nvme')
+
+SYS_BLOCK_PATH = '/sys/block'
+
+# Whole disks worth polling: SCSI/SATA/SAS disks (sda..sdzz) and NVMe namespaces
+BLOCK_DEVICE_PATTERN = re.compile(r'^(sd[a-z]+|nvme\d+n\d+)$')
+
+HWMON_BUS_SUBSYSTEMS = ('pci', 'i2c', 'platform', 'isa', 'acpi', 'scsi')
+
+# Where on-disk caches (SDR dump, Ceph OSD index) are kept between agent restarts
+CACHE_DIR = '/opt/datadog-agent/run/temperatures'
+
+CEPH_OSD_PATH = '/var/lib/ceph/osd'
+# OSD directory symlinks to the devices backing it; only the data device decides the device class
+CEPH_OSD_DEVICES = ('block', 'block.db', 'block.wal')
+
+
+def _hwmon_chip_name(hwmon_dir):
+    """
+    Builds the libsensors chip name (e.g. k10temp-pci-00c3, nvme-pci-4200) for a hwmon directory.
+    """
+    try:
+        with open(os.path.join(hwmon_dir, 'name'), 'r') as f:
+            name = f.read().strip()
+    except (IOError, OSError):
+        return None
+
+    device_dir = os.path.join(hwmon_dir, 'device')
+    if not os.path.exists(device_dir):
+        return f"{name}-virtual-0"
+
+    device = os.path.basename(os.path.realpath(device_dir))
+    subsystem = os.path.basename(os.path.realpath(os.path.join(device_dir, 'subsystem')))
+    # Class devices such as nvme0 are named after the bus device they belong to
+    if subsystem not in HWMON_BUS_SUBSYSTEMS and os.path.exists(os.path.join(device_dir, 'device')):
+        device_dir = os.path.join(device_dir, 'device')
+        device = os.path.basename(os.path.realpath(device_dir))
+        subsystem = os.path.basename(os.path.realpath(os.path.join(device_dir, 'subsystem')))
+
+    if subsystem == 'pci':
+        # 0000:00:18.3 -> (domain << 16) + (bus << 8) + (slot << 3) + function
+        match = re.match(r'^([0-9a-f]+):([0-9a-f]+):([0-9a-f]+)\.([0-7])$', device)
+        if match:
+            domain, bus, slot, function = (int(part, 16) for part in match.groups())
+            return f"{name}-pci-{(domain << 16) + (bus << 8) + (slot << 3) + function:04x}"
+    elif subsystem == 'i2c':
+        match = re.match(r'^(\d+)-([0-9a-f]+)$', device)
+        if match:
+            return f"{name}-i2c-{int(match.group(1))}-{int(match.group(2), 16):02x}"
+    elif subsystem in ('platform', 'isa'):
+        match = re.match(r'^.+\.(\d+)$', device)
+        if match:
+            return f"{name}-isa-{int(match.group(1)):04x}"
+    elif subsystem == 'acpi':
+        return f"{name}-acpi-0"
+    elif subsystem == 'scsi':
+        # host:channel:target:lun
+        match = re.match(r'^(\d+):\d+:\d+:(\d+)$', device)
+        if match:
+            return f"{name}-scsi-{int(match.group(1))}-{int(match.group(2)):x}"
+    return f"{name}-virtual-0"
+
+
+def _hwmon_block_devices(hwmon_dir):
+    """
+    Returns the block devices (e.g. sdb, nvme0n1) whose temperature a drivetemp or nvme hwmon chip reports.
+    """
+    device_dir = os.path.realpath(os.path.join(hwmon_dir, 'device'))
+    # drivetemp hangs off the SCSI device (.../0:0:1:0/block/sdb), nvme off the controller or its PCI device
+    patterns = ('block/*', 'nvme*n*', 'nvme/*/nvme*n*')
+    paths = [path for pattern in patterns for path in glob.glob(os.path.join(device_dir, pattern))]
+    return sorted(os.path.basename(path) for path in paths if BLOCK_DEVICE_PATTERN.match(os.path.basename(path)))
+
+
+def k10temp_sockets(log, chips, cpu_path=CPU_PATH):
+    """
+    Maps k10temp chip names (e.g. k10temp-pci-00c3) to the physical package id of their CPU socket.
+
+    This is a heuristic: the data fabric devices k10temp binds to all sit on the first PCI bus, so
+    their numa_node does not tell which socket they belong to. There is one per AMD data fabric node,
+    at function 3 of PCI device 0x18 + node, so ordering the chips by PCI address gives the node
+    order, and nodes are split evenly across the packages listed in the sysfs CPU topology: one node
+    per socket since Zen 2, four on Naples. A warning is logged when they do not split evenly.
+    """
+    packages = set()
+    for path in glob.glob(os.path.join(cpu_path, 'cpu[0-9]*', 'topology', 'physical_package_id')):
+        package = _read_sysfs_attribute(path)
+        if package is not None and package.isdigit():
+            packages.add(int(package))
+    packages = sorted(packages) or [0]
+    chips = sorted(chips, key=lambda chip: int(chip.rsplit('-', 1)[1], 16))
+    if len(chips) % len(packages):
+        log.warning("%d k10temp chips do not split evenly across %d CPU packages, socket rollups may mix sockets.", len(chips), len(packages))
+    return {chip: packages[index * len(packages) // len(chips)] for index, chip in enumerate(chips)}
+
+
+class SysfsSensorReader(object):
+    """
+    Reads hwmon and thermal zone temperatures straight from sysfs.
+
+    Sensors are discovered once; the attribute files are kept open and re-read with
+    os.pread() on every call so each interval costs a handful of syscalls instead of a fork.
+    Every `rescan_interval` seconds the hwmon and thermal directories are listed again so chips
+    that show up later (hot-plugged NVMe, drivetemp loaded after boot) get discovered too.
+    """
+
+    def __init__(self, log, hwmon_path=HWMON_PATH, thermal_path=THERMAL_PATH, rescan_interval=60):
+        self.log = log
+        self.hwmon_path = hwmon_path
+        self.thermal_path = thermal_path
+        self.rescan_interval = rescan_interval
+        self._chips = []
+        self._zones = []
+        self._drives = {}
+        self._drive_chips = {}
+        self._discovered = False
+        self._listing = None
+        self._rescan_at = 0
+
+    def _open(self, path):
+        try:
+            return os.open(path, os.O_RDONLY)
+        except OSError as e:
+            self.log.debug("Cannot open %s: %s", path, e)
+            return None
+
+    def _list_devices(self):
+        listing = []
+        for path in (self.hwmon_path, self.thermal_path):
+            try:
+                listing.append(sorted(os.listdir(path)))
+            except OSError:
+                listing.append([])
+        return listing
+
+    def _ensure_discovered(self):
+        if self._discovered and time.monotonic() >= self._rescan_at:
+            self._rescan_at = time.monotonic() + self.rescan_interval
+            if self._list_devices() != self._listing:
+                self.log.info("hwmon or thermal zone devices changed, rediscovering sensors.")
+                self._discovered = False
+        if not self._discovered:
+            self.discover()
+
+    def discover(self):
+        """
+        Walks hwmon and thermal zone directories and opens every temperature attribute.
+        """
+        self.close()
+        self._listing = self._list_devices()
+        self._rescan_at = time.monotonic() + self.rescan_interval
+        if os.path.isdir(self.hwmon_path):
+            for hwmon in sorted(os.listdir(self.hwmon_path), key=lambda d: int(re.sub(r'\D', '', d) or 0)):
+                hwmon_dir = os.path.join(self.hwmon_path, hwmon)
+                chip_name = _hwmon_chip_name(hwmon_dir)
+                if chip_name is None:
+                    continue
+                # Older drivers expose the attributes on the device directory instead of the hwmon one
+                attr_dir = hwmon_dir
+                if not any(f.startswith('temp') for f in os.listdir(hwmon_dir)):
+                    attr_dir = os.path.join(hwmon_dir, 'device')
+                    if not os.path.isdir(attr_dir):
+                        continue
+                files = set(os.listdir(attr_dir))
+                indexes = sorted(int(m.group(1)) for m in (re.match(r'^temp(\d+)_input$', f) for f in files) if m)
+                components = []
+                for index in indexes:
+                    fd = self._open(os.path.join(attr_dir, f"temp{index}_input"))
+                    if fd is None:
+                        continue
+                    label = f"temp{index}"
+                    if f"temp{index}_label" in files:
+                        try:
+                            with open(os.path.join(attr_dir, f"temp{index}_label"), 'r') as f:
+                                label = f.read().strip() or label
+                        except (IOError, OSError):
+                            pass
+                    limits = []
+                    for suffix, key in HWMON_LIMITS:
+                        if f"temp{index}_{suffix}" in files:
+                            limit_fd = self._open(os.path.join(attr_dir, f"temp{index}_{suffix}"))
+                            if limit_fd is not None:
+                                limits.append((key, limit_fd))
+                    components.append((label, fd, limits))
+                if components:
+                    self._chips.append((chip_name, components))
+                    if chip_name.split('-')[0] in DRIVE_HWMON_NAMES:
+                        self._drive_chips[chip_name] = _hwmon_block_devices(hwmon_dir)
+                        # The first sensor is the drive temperature (nvme calls it Composite)
+                        for block_device in self._drive_chips[chip_name]:
+                            self._drives[block_device] = components[0]
+
+        if os.path.isdir(self.thermal_path):
+            for zone_dir in sorted(os.listdir(self.thermal_path)):
+                if zone_dir.startswith("thermal_zone"):
+                    fd = self._open(os.path.join(self.thermal_path, zone_dir, 'temp'))
+                    if fd is not None:
+                        self._zones.append((zone_dir.replace("thermal_zone", ""), fd))
+
+        self._discovered = True
+        self.log.debug("Discovered %d hwmon chips, %d drive sensors and %d thermal zones.", len(self._chips), len(self._drives), len(self._zones))
+
+    def _read_millidegrees(self, fd):
+        try:
+            return int(os.pread(fd, 32, 0)) / 1000
+        except ValueError:
+            return None
+        except OSError as e:
+            # ENODEV/ENOENT mean the device went away; anything else (EIO, ENODATA) is a transient read error
+            if e.errno in (errno.ENODEV, errno.ENOENT, errno.EBADF):
+                self._discovered = False
+            return None
+
+    def read_sensors(self, exclude=(), skip_chips=()):
+        """
+        Returns the same {sensor_name: [{'component', 'temp', 'low', 'high', 'crit'}]} structure as parse_sensors(),
+        leaving out chips whose driver is in `exclude` and the chips named in `skip_chips`.
+        """
+        self._ensure_discovered()
+        sensors = {}
+        for chip_name, components in self._chips:
+            if chip_name.split('-')[0] in exclude or chip_name in skip_chips:
+                continue
+            readings = []
+            for label, fd, limits in components:
+                temperature = self._read_millidegrees(fd)
+                if temperature is None:
+                    continue
+                sensor_data = {'component': label, 'temp': temperature}
+                for key, limit_fd in limits:
+                    value = self._read_millidegrees(limit_fd)
+                    if value is not None:
+                        sensor_data[key] = value
+                readings.append(sensor_data)
+            sensors[chip_name] = readings
+        return sensors
+
+    def read_thermal_zones(self):
+        """
+        Returns a list of {'zone_id', 'temp'} for every readable thermal zone.
+        """
+        self._ensure_discovered()
+        thermal_zones = []
+        for zone_id, fd in self._zones:
+            temperature = self._read_millidegrees(fd)
+            if temperature is not None:
+                thermal_zones.append({"zone_id": zone_id, "temp": temperature})
+        return thermal_zones
+
+    def drive_chips(self):
+        """
+        Returns {chip_name: [block devices]} for the drivetemp and nvme chips, e.g. {'drivetemp-scsi-0-0': ['sdb']}.
+        """
+        self._ensure_discovered()
+        return self._drive_chips
+
+    def read_drive_temperatures(self, devices=None):
+        """
+        Returns {device: {'current', 'crit'}} for every drive (or those of `devices`) with a drivetemp or nvme
+        hwmon sensor, in the same shape as get_drive_temperatures(). Other drives are not touched.
+        """
+        self._ensure_discovered()
+        drives = {}
+        for device, (_, fd, limits) in self._drives.items():
+            if devices is not None and device not in devices:
+                continue
+            temperature = self._read_millidegrees(fd)
+            if temperature is None:
+                continue
+            drives[device] = {'current': temperature}
+            for key, limit_fd in limits:
+                if key == 'crit':
+                    crit = self._read_millidegrees(limit_fd)
+                    if crit is not None:
+                        drives[device]['crit'] = crit
+        return drives
+
+    def close(self):
+        fds = [fd for _, fd in self._zones]
+        for _, components in self._chips:
+            for _, fd, limits in components:
+                fds.append(fd)
+                fds.extend(limit_fd for _, limit_fd in limits)
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._chips = []
+        self._zones = []
+        self._drives = {}
+        self._drive_chips = {}
+        self._discovered = False
+
+
+def _read_sysfs_attribute(path, binary=False):
+    try:
+        with open(path, 'rb' if binary else 'r') as f:
+            return f.read() if binary else f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _tag_value(value):
+    return re.sub(r'\s+', '_', value.strip())
+
+
+class BlockDeviceIndex(object):
+    """
+    Keeps the list of disks from /sys/block together with their stable identity.
+
+    Each refresh() costs one listdir and one readlink per disk; identity attributes (WWN, serial,
+    model, HBA slot) are only read for disks that appeared or moved since the previous call.
+    """
+
+    def __init__(self, log, sys_block_path=SYS_BLOCK_PATH):
+        self.log = log
+        self.sys_block_path = sys_block_path
+        self._devices = {}
+
+    def refresh(self):
+        """
+        Returns {device: {'link', 'wwn', 'serial', 'model', 'device_class', 'enclosure_slot', 'bus_address'}} for every disk currently present.
+        """
+        try:
+            names = [name for name in os.listdir(self.sys_block_path) if BLOCK_DEVICE_PATTERN.match(name)]
+        except OSError as e:
+            self.log.warning("Cannot list %s: %s", self.sys_block_path, e)
+            return {}
+
+        devices = {}
+        for name in names:
+            try:
+                link = os.readlink(os.path.join(self.sys_block_path, name))
+            except OSError:
+                link = None
+            cached = self._devices.get(name)
+            if cached is not None and cached['link'] == link:
+                devices[name] = cached
+            else:
+                devices[name] = self._identify(name, link)
+                self.log.debug("Indexed block device %s: %s", name, devices[name])
+        self._devices = devices
+        return devices
+
+    def tags(self, device):
+        """
+        Returns the identity tags for a device, e.g. ('wwn:naa.5000c500a1b2c3d4', 'serial:ZA1B2C3D').
+        """
+        return self._devices.get(device, {}).get('tags', ())
+
+    def _identify(self, name, link):
+        device_dir = os.path.join(self.sys_block_path, name, 'device')
+        identity = {'link': link}
+
+        wwn = _read_sysfs_attribute(os.path.join(self.sys_block_path, name, 'wwid')) or _read_sysfs_attribute(os.path.join(device_dir, 'wwid'))
+        if wwn:
+            identity['wwn'] = wwn
+
+        serial = _read_sysfs_attribute(os.path.join(device_dir, 'serial'))
+        if not serial:
+            # SCSI disks expose the unit serial number through the raw VPD page 0x80
+            page = _read_sysfs_attribute(os.path.join(device_dir, 'vpd_pg80'), binary=True)
+            if page and len(page) > 4:
+                serial = page[4:4 + int.from_bytes(page[2:4], 'big')].decode('ascii', 'replace').strip()
+        if serial:
+            identity['serial'] = serial
+
+        model = _read_sysfs_attribute(os.path.join(device_dir, 'model'))
+        if model:
+            identity['model'] = model
+
+        if name.startswith('nvme'):
+            identity['device_class'] = 'nvme'
+        elif _read_sysfs_attribute(os.path.join(self.sys_block_path, name, 'queue', 'rotational')) == '0':
+            identity['device_class'] = 'ssd'
+        else:
+            identity['device_class'] = 'hdd'
+
+        # SES enclosures link the disk to its bay: device/enclosure_device:Slot 05 -> .../enclosure/0:0:30:0/Slot 05,
+        # identified by the enclosure's logical id and the slot number, which survive reboots and re-cabling
+        for slot_link in glob.glob(os.path.join(device_dir, 'enclosure_device:*'))[:1]:
+            slot_dir = os.path.realpath(slot_link)
+            enclosure_id = _read_sysfs_attribute(os.path.join(os.path.dirname(slot_dir), 'id'))
+            slot = _read_sysfs_attribute(os.path.join(slot_dir, 'slot')) or os.path.basename(slot_dir)
+            if enclosure_id:
+                identity['enclosure_slot'] = f"{enclosure_id}/{slot}"
+
+        # Where the disk sits on the bus, assigned at probe time so it can change across reboots:
+        # .../host0/port-0:1/end_device-0:1/target0:0:1/0:0:1:0/block/sdb -> 0:0:1:0
+        # .../0000:41:00.0/nvme/nvme0/nvme0n1 -> 0000:41:00.0
+        if link:
+            match = re.search(r'/(\d+:\d+:\d+:\d+)/block/', link) or re.search(r'/([0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7])/nvme/', link)
+            if match:
+                identity['bus_address'] = match.group(1)
+
+        # Built once here so every interval reuses the same tuple
+        identity['tags'] = tuple(f"{key}:{_tag_value(identity[key])}" for key in ('wwn', 'serial', 'model', 'enclosure_slot', 'bus_address') if identity.get(key))
+        return identity
+
+
+class CephOsdIndex(object):
+    """
+    Maps disks to the Ceph OSDs they back, from the `block`, `block.db` and `block.wal` symlinks under /var/lib/ceph/osd.
+
+    Symlinks are followed through device-mapper (LVM, dm-crypt) and partitions down to the disks in
+    /sys/block. The crush device class comes from the ceph-volume LVM tags, which takes a `sudo lvs`,
+    so the index is persisted to `index_path` and only rebuilt when the symlinks or the disk layout
+    change; refresh() otherwise costs one listdir and a few readlinks per OSD.
+    """
+
+    def __init__(self, log, osd_path=CEPH_OSD_PATH, sys_block_path=SYS_BLOCK_PATH, index_path=None, crush_host=None):
+        self.log = log
+        self.osd_path = osd_path
+        self.sys_class_block_path = os.path.join(os.path.dirname(sys_block_path), 'class', 'block')
+        self.index_path = index_path or os.path.join(CACHE_DIR, 'ceph-osd.json')
+        self.crush_host = crush_host or socket.gethostname().split('.')[0]
+        self._signature = None
+        self._tags = {}
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            self._signature = index['signature']
+            self._tags = {device: tuple(tags) for device, tags in index['tags'].items()}
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def refresh(self, devices):
+        """
+        Rebuilds the index if the OSD symlinks or the disks in `devices` (from BlockDeviceIndex.refresh()) changed.
+        """
+        try:
+            entries = sorted(entry for entry in os.listdir(self.osd_path) if '-' in entry)
+        except OSError:
+            entries = []
+        links = []
+        for entry in entries:
+            for role in CEPH_OSD_DEVICES:
+                path = os.path.join(self.osd_path, entry, role)
+                try:
+                    links.append(f"{entry}/{role}={os.readlink(path)}={os.path.realpath(path)}")
+                except OSError:
+                    continue
+        if not links:
+            self._tags = {}
+            return
+        links.extend(f"{device}={identity['link']}" for device, identity in sorted(devices.items()))
+        signature = '\n'.join(links)
+        if signature == self._signature:
+            return
+
+        self.log.info("Ceph OSD layout changed, rebuilding the device index.")
+        crush_classes = self._crush_device_classes()
+        tags = {}
+        for entry in entries:
+            osd_id = entry.split('-', 1)[1]
+            for role in CEPH_OSD_DEVICES:
+                path = os.path.join(self.osd_path, entry, role)
+                if not os.path.islink(path):
+                    continue
+                for disk in self._disks(os.path.basename(os.path.realpath(path))):
+                    disk_tags = tags.setdefault(disk, [f"ceph_crush_host:{self.crush_host}"])
+                    disk_tags.append(f"ceph_osd:osd.{osd_id}")
+                    if role == 'block':
+                        device_class = crush_classes.get(osd_id) or devices.get(disk, {}).get('device_class')
+                        if device_class:
+                            disk_tags.append(f"ceph_device_class:{device_class}")
+        self._tags = {disk: tuple(disk_tags) for disk, disk_tags in tags.items()}
+        self._signature = signature
+        self.log.debug("Ceph OSD index: %s", self._tags)
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump({'signature': signature, 'tags': self._tags}, f)
+            os.replace(self.index_path + '.tmp', self.index_path)
+        except OSError as e:
+            self.log.warning("Cannot persist the Ceph OSD index to %s: %s", self.index_path, e)
+
+    def tags(self, device):
+        """
+        Returns the Ceph tags for a disk, e.g. ('ceph_crush_host:pve1', 'ceph_osd:osd.3', 'ceph_device_class:hdd').
+        """
+        return self._tags.get(device, ())
+
+    def _disks(self, name):
+        # dm-3 -> slaves/dm-2 -> slaves/sdb3 -> sdb
+        path = os.path.realpath(os.path.join(self.sys_class_block_path, name))
+        if os.path.exists(os.path.join(path, 'partition')):
+            return {os.path.basename(os.path.dirname(path))}
+        try:
+            slaves = os.listdir(os.path.join(path, 'slaves'))
+        except OSError:
+            slaves = []
+        if not slaves:
+            return {name}
+        return set().union(*(self._disks(slave) for slave in slaves))
+
+    def _crush_device_classes(self):
+        """
+        Returns {osd_id: crush_device_class} from the ceph-volume LVM tags, empty if lvs is unavailable.
+        """
+        command = ['sudo', '-n', '/usr/sbin/lvs', '--readonly', '--reportformat', 'json', '-o', 'lv_tags']
+        try:
+            report = json.loads(subprocess.check_output(command, universal_newlines=True, stderr=subprocess.PIPE, timeout=30))
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired, ValueError) as e:
+            self.log.warning("Unable to read ceph-volume LVM tags: %s", e)
+            return {}
+        classes = {}
+        for lv in (lv for group in report.get('report', []) for lv in group.get('lv', [])):
+            lv_tags = dict(tag.split('=', 1) for tag in lv.get('lv_tags', '').split(',') if '=' in tag)
+            if lv_tags.get('ceph.type') == 'block' and lv_tags.get('ceph.crush_device_class'):
+                classes[lv_tags['ceph.osd_id']] = lv_tags['ceph.crush_device_class']
+        return classes
+
+
+# (metric, reading key) submitted for every sensor component, tagged sensor: and component:
+SENSOR_METRICS = (
+    ('custom.temperature.temp', 'temp'),
+    ('custom.temperature.low', 'low'),
+    ('custom.temperature.high', 'high'),
+    ('custom.temperature.crit', 'crit'),
+)
+# Also submitted for NVMe components, tagged drive:<sensor>
+NVME_METRICS = (
+    ('custom.temperature.nvme.current', 'temp'),
+    ('custom.temperature.nvme.low', 'low'),
+    ('custom.temperature.nvme.high', 'high'),
+    ('custom.temperature.nvme.crit', 'crit'),
+)
+# Also submitted for the k10temp Tctl component, tagged cpu:<sensor>-Tctl
+CPU_METRICS = (
+    ('custom.temperature.cpu', 'temp'),
+)
+# Limits that only change with the hardware, sent on discovery or change when aggregate_sensors is on
+THRESHOLD_KEYS = ('low', 'high', 'crit')
+# Per-socket rollups of the k10temp dies and CCDs, tagged socket:
+SOCKET_METRICS = (
+    ('custom.temperature.socket.max', max),
+    ('custom.temperature.socket.avg', lambda temps: sum(temps) / len(temps)),
+)
+# Submitted for every drive reading, tagged drive: and the drive identity
+DRIVE_METRICS = (
+    ('custom.temperature.hdd.current', 'current'),
+    ('custom.temperature.hdd.crit', 'crit'),
+)
+
+# Kinds of BMC sensors read, with the `ipmitool sdr type` they are listed under and the metric they are reported as
+IPMI_SENSOR_TYPES = (
+    ('temperature', 'Temperature', 'custom.temperature.bmc.current'),
+    ('fan', 'Fan', 'custom.temperature.bmc.fan'),
+    ('voltage', 'Voltage', 'custom.temperature.bmc.voltage'),
+)
+
+
+class IpmiSensorReader(object):
+    """
+    Reads BMC temperatures, fans and voltages with ipmitool against an on-disk copy of the SDR repository.
+
+    Walking the SDR repository is what makes `ipmitool sdr` take seconds, so it is dumped once and
+    only dumped again when the BMC reports a new SDR addition or erase timestamp, which is checked
+    every `sdr_check_interval` seconds. Each read is then a single `ipmitool -S <dump> sensor reading`
+    for every cached sensor.
+    """
+
+    def __init__(self, log, ipmitool='/usr/bin/ipmitool', cache_dir=CACHE_DIR, sdr_check_interval=3600):
+        self.log = log
+        self.ipmitool = ipmitool
+        self.cache_dir = cache_dir
+        self.sdr_path = os.path.join(cache_dir, 'sdr.bin')
+        self.index_path = os.path.join(cache_dir, 'sdr.json')
+        self.schedule = PollSchedule({'sdr': sdr_check_interval})
+        self._index = None
+
+    def _run(self, stats, *args):
+        stats['forks'] += 1
+        return subprocess.check_output([self.ipmitool] + list(args), universal_newlines=True, stderr=subprocess.PIPE, timeout=30)
+
+    def _sdr_timestamp(self, stats):
+        output = self._run(stats, 'sdr', 'info')
+        return ' / '.join(line.split(':', 1)[1].strip() for line in output.splitlines() if line.strip().startswith(('Most recent Addition', 'Most recent Erase')))
+
+    def _refresh_cache(self, stats):
+        timestamp = self._sdr_timestamp(stats)
+        if self._index is None:
+            try:
+                with open(self.index_path, 'r') as f:
+                    self._index = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+        if self._index is not None and self._index.get('timestamp') == timestamp and os.path.exists(self.sdr_path):
+            return
+
+        self.log.info("SDR repository changed (%s), dumping it to %s.", timestamp, self.sdr_path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._run(stats, 'sdr', 'dump', self.sdr_path + '.tmp')
+        os.replace(self.sdr_path + '.tmp', self.sdr_path)
+        sensors = {}
+        for kind, sdr_type, _ in IPMI_SENSOR_TYPES:
+            # "CPU1 Temp        | 01h | ok  |  3.1 | 45 degrees C"
+            output = self._run(stats, '-S', self.sdr_path, 'sdr', 'type', sdr_type)
+            sensors[kind] = [line.split('|')[0].strip() for line in output.splitlines() if line.count('|') >= 4]
+        self._index = {'timestamp': timestamp, 'sensors': sensors}
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self._index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def read(self, stats):
+        """
+        Returns {'temperature': {sensor: value}, 'fan': {...}, 'voltage': {...}}, or None if the BMC could not be read.
+        """
+        try:
+            if self.schedule.due('sdr') or self._index is None:
+                self._refresh_cache(stats)
+            kinds = {name: kind for kind, names in self._index['sensors'].items() for name in names}
+            if not kinds:
+                return {}
+            # "CPU1 Temp        | 45"
+            output = self._run(stats, '-S', self.sdr_path, 'sensor', 'reading', *kinds)
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired, ValueError) as e:
+            stats['errors'] += 1
+            self.log.warning("Unable to read BMC sensors with %s: %s", self.ipmitool, e)
+            return None
+
+        readings = {kind: {} for kind, _, _ in IPMI_SENSOR_TYPES}
+        for line in output.splitlines():
+            name, _, value = line.rpartition('|')
+            name = name.strip()
+            if name in kinds:
+                try:
+                    readings[kinds[name]][name] = float(value)
+                except ValueError:
+                    continue
+        return readings
+
+
+class SensorHistory(object):
+    """
+    Keeps the last `size` samples of every sensor in fixed-size, array-backed ring buffers.
+
+    Memory is bounded by 16 bytes per sample per sensor whatever the sampling rate.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, timestamp, value):
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                # [timestamps, values, number of samples ever added]
+                buffer = self._buffers[key] = [array('d', [0.0]) * self.size, array('d', [0.0]) * self.size, 0]
+            index = buffer[2] % self.size
+            buffer[0][index] = timestamp
+            buffer[1][index] = value
+            buffer[2] += 1
+
+    def summarize(self, since):
+        """
+        Returns {key: (min, max, avg, slope)} over the samples taken after `since`, the slope being the
+        least-squares rate of change in degrees per minute (None with fewer than two samples).
+        """
+        summaries = {}
+        with self._lock:
+            for key, (timestamps, values, count) in self._buffers.items():
+                samples = [(timestamps[i], values[i]) for i in range(min(count, self.size)) if timestamps[i] > since]
+                if not samples:
+                    continue
+                readings = [value for _, value in samples]
+                average = sum(readings) / len(readings)
+                slope = None
+                if len(samples) > 1:
+                    mean_time = sum(timestamp for timestamp, _ in samples) / len(samples)
+                    variance = sum((timestamp - mean_time) ** 2 for timestamp, _ in samples)
+                    if variance:
+                        slope = 60 * sum((timestamp - mean_time) * (value - average) for timestamp, value in samples) / variance
+                summaries[key] = (min(readings), max(readings), average, slope)
+        return summaries
+
+
+class PollSchedule(object):
+    """
+    Tracks when each source or device class is next due.
+
+    Intervals are in seconds, 0 meaning every run. Each next run is pushed out by the interval
+    plus or minus `jitter` (a fraction of it) so that hosts and classes don't poll in lockstep.
+    """
+
+    def __init__(self, intervals, jitter=0):
+        self.intervals = intervals
+        self.jitter = jitter
+        self._next_run = {}
+
+    def due(self, key):
+        """
+        Returns True and schedules the next run if `key` is due now.
+        """
+        now = time.monotonic()
+        if now < self._next_run.get(key, 0):
+            return False
+        interval = self.intervals.get(key, 0)
+        self._next_run[key] = now + interval * (1 + random.uniform(-self.jitter, self.jitter))
+        return True
+
+
+class BackgroundCollector(threading.Thread):
+    """
+    Calls collect() every `interval` seconds on a daemon thread and keeps the latest result in `snapshot`.
+
+    The snapshot is replaced as a whole, so readers never see a half-updated one.
+    """
+
+    def __init__(self, collect, interval, log):
+        super(BackgroundCollector, self).__init__(name='temperatures-collector', daemon=True)
+        self._collect = collect
+        self.interval = interval
+        self.log = log
+        self.snapshot = None
+        self._stop_event = threading.Event()
+        self._on_exit = None
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                started = time.monotonic()
+                try:
+                    self.snapshot = self._collect()
+                except Exception:
+                    self.log.exception("Background temperature collection failed.")
+                self._stop_event.wait(max(0, self.interval - (time.monotonic() - started)))
+        finally:
+            if self._on_exit is not None:
+                self._on_exit()
+
+    def stop(self, on_exit=None, timeout=5):
+        """
+        Stops the thread after the collection in progress, if any, then calls `on_exit` from it.
+
+        Waits up to `timeout` seconds; a collection stuck past that (e.g. on smartctl) still runs
+        `on_exit` when it returns, so resources it uses are never released under it.
+        """
+        self._on_exit = on_exit
+        self._stop_event.set()
+        if self.ident is None:
+            # Never started, nothing else will call it
+            if on_exit is not None:
+                on_exit()
+        elif threading.current_thread() is not self:
+            self.join(timeout)
+
+
 class TemperaturesCheck(AgentCheck):
     def __init__(self, name, init_config, agentConfig, instances):
         super(TemperaturesCheck, self).__init__(name, init_config, agentConfig, instances)
         self.log_file_path = instances[0].get('log_file', '/tmp/temp_check.log')
         self.log = logging.getLogger(__name__)
-        self.log.setLevel(logging.DEBUG)
-        handler = logging.FileHandler(self.log_file_path)
-        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-        if handler not in self.log.handlers:
+        self.log.setLevel(getattr(logging, str(instances[0].get('log_level', 'INFO')).upper(), logging.INFO))
+        if not any(getattr(h, 'baseFilename', None) == os.path.abspath(self.log_file_path) for h in self.log.handlers):
+            handler = RotatingFileHandler(
+                self.log_file_path,
+                maxBytes=instances[0].get('log_max_bytes', 10 * 1024 * 1024),
+                backupCount=instances[0].get('log_backup_count', 3),
+            )
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
             self.log.addHandler(handler)
-
-    def _read_thermal_zone(self, zone):
-        path = f"/sys/class/thermal/thermal_zone{zone}/temp"
-        try:
-            with open(path, "r") as f:
-                return int(f.read().strip()) / 1000
-        except (IOError, ValueError) as e:
-            self.log.debug("Cannot read temperature from %s: %s", path, e)
-            return None
+        # Full sensors and smartctl output is only logged for this fraction of debug payloads
+        for log_filter in [f for f in self.log.filters if isinstance(f, PayloadSampler)]:
+            self.log.removeFilter(log_filter)
+        self.log.addFilter(PayloadSampler(instances[0].get('log_payload_sample_rate', 0.01)))
+        # 'sysfs' reads hwmon directly and falls back to the sensors binary; 'sensors' always forks it
+        self.sensors_source = instances[0].get('sensors_source', 'sysfs')
+        self.sensors_json = instances[0].get('sensors_json', True)
+        self.sensors_path = instances[0].get('sensors_path', '/usr/bin/sensors')
+        self.skip_standby_drives = instances[0].get('skip_standby_drives', False)
+        self.drive_cache = {}
+        self.device_index = BlockDeviceIndex(self.log, sys_block_path=instances[0].get('sys_block_path', SYS_BLOCK_PATH))
+        self.ceph_index = CephOsdIndex(
+            self.log,
+            osd_path=instances[0].get('ceph_osd_path', CEPH_OSD_PATH),
+            sys_block_path=instances[0].get('sys_block_path', SYS_BLOCK_PATH),
+            index_path=instances[0].get('ceph_osd_index'),
+            crush_host=instances[0].get('ceph_crush_host'),
+        )
+        self.smartctl_concurrency = instances[0].get('smartctl_concurrency', 8)
+        self.smartctl_timeout = instances[0].get('smartctl_timeout', 10)
+        self.smartctl_total_timeout = instances[0].get('smartctl_total_timeout', 30)
+        self.smartctl_helper_socket = instances[0].get('smartctl_helper_socket')
+        # Read drive temperatures from drivetemp/nvme hwmon sensors and only run smartctl for the rest
+        self.drive_hwmon = instances[0].get('drive_hwmon', True)
+        self.sysfs_reader = SysfsSensorReader(
+            self.log,
+            hwmon_path=instances[0].get('hwmon_path', HWMON_PATH),
+            thermal_path=instances[0].get('thermal_path', THERMAL_PATH),
+            rescan_interval=instances[0].get('hwmon_rescan_interval', 60),
+        )
+        # Collect on a background thread and only emit the latest snapshot from check()
+        self.background_collection = instances[0].get('background_collection', False)
+        self.collection_interval = instances[0].get('collection_interval', 15)
+        self.collector = None
+        # Emit the snapshot served by `temperatures.py serve` instead of collecting in the agent
+        self.snapshot_url = instances[0].get('snapshot_url')
+        self.snapshot_timeout = instances[0].get('snapshot_timeout', 5)
+        self._remote_snapshot = None
+        self._remote_etag = None
+        self.schedule = PollSchedule(instances[0].get('poll_intervals', {}), jitter=instances[0].get('poll_jitter', 0))
+        # Disks and the drive classes due in the collection in progress
+        self._devices = {}
+        self._due_classes = set()
+        self.snapshot = {'sensors': None, 'thermal_zones': [], 'drives': {}, 'ipmi': None, 'collected_at': {}, 'stats': new_collection_stats()}
+        self._stats = new_collection_stats()
+        # Sample sysfs sensors every history_sample_interval seconds into ring buffers, 0 to disable
+        self.history_sample_interval = instances[0].get('history_sample_interval', 0)
+        self.history = SensorHistory(instances[0].get('history_size', 120))
+        self.history_sampler = None
+        self._history_reader = SysfsSensorReader(
+            self.log,
+            hwmon_path=instances[0].get('hwmon_path', HWMON_PATH),
+            thermal_path=instances[0].get('thermal_path', THERMAL_PATH),
+            rescan_interval=instances[0].get('hwmon_rescan_interval', 60),
+        )
+        self._history_emitted_at = time.time()
+        # BMC sensors through ipmitool, read on the 'ipmi' poll interval
+        self.ipmi_reader = None
+        if instances[0].get('ipmi', False):
+            self.ipmi_reader = IpmiSensorReader(
+                self.log,
+                ipmitool=instances[0].get('ipmitool_path', '/usr/bin/ipmitool'),
+                cache_dir=instances[0].get('ipmi_cache_dir', CACHE_DIR),
+                sdr_check_interval=instances[0].get('ipmi_sdr_check_interval', 3600),
+            )
+        # Tag tuples built once per sensor component, thermal zone and drive
+        self._sensor_plans = {}
+        self._zone_tags = {}
+        self._drive_tags = {}
+        self._history_tags = {}
+        self._bmc_tags = {}
+        # Roll k10temp dies and CCDs up per socket and only send thresholds on discovery or change;
+        # per-component k10temp and NVMe sub-sensor series are then opt-in through raw_sensor_series
+        self.aggregate_sensors = instances[0].get('aggregate_sensors', False)
+        self.raw_sensor_series = instances[0].get('raw_sensor_series', not self.aggregate_sensors)
+        self.cpu_path = instances[0].get('cpu_path', CPU_PATH)
+        self._chip_sockets = {}
+        self._socket_tags = {}
+        self._thresholds = {}
 
     def _read_all_thermal_zones(self):
-        thermal_zones = []
-        thermal_zones_path = "/sys/class/thermal/"
-        if os.path.exists(thermal_zones_path):
-            for zone_dir in os.listdir(thermal_zones_path):
-                if zone_dir.startswith("thermal_zone"):
-                    zone_id = zone_dir.replace("thermal_zone", "")
-                    cpu_temp = self._read_thermal_zone(zone_id)
-                    if cpu_temp is not None:
-                        thermal_zones.append({"zone_id": zone_id, "temp": cpu_temp})
-        return thermal_zones
-
-    def check(self, instance):
-        reported_metrics = []
+        return self.sysfs_reader.read_thermal_zones()
 
-        self.log.info("Starting temperatures check.") # Added for guaranteed visibility
+    def _run_sensors_command(self):
+        if self.sensors_json:
+            self._stats['forks'] += 1
+            try:
+                return parse_sensors_json(subprocess.check_output([self.sensors_path, "-j"], universal_newlines=True, stderr=subprocess.DEVNULL))
+            except (OSError, subprocess.CalledProcessError, ValueError, AttributeError) as e:
+                # lm-sensors older than 3.5 has no -j, don't try it again
+                self.log.info("Unable to use 'sensors -j', falling back to text output: %s", e)
+                self.sensors_json = False
 
-        self.log.info("About to run 'sensors' command.")
+        self.log.debug("About to run 'sensors' command.")
+        self._stats['forks'] += 1
         try:
-            sensors_output = subprocess.check_output(["/usr/bin/sensors"], universal_newlines=True)
-            self.log.info("Successfully ran 'sensors' command. Output: %s", sensors_output)
+            sensors_output = subprocess.check_output([self.sensors_path], universal_newlines=True)
+            self.log.debug("Successfully ran 'sensors' command. Output: %s", sensors_output, extra=PAYLOAD)
         except (OSError, subprocess.CalledProcessError) as e:
+            self._stats['errors'] += 1
             self.log.error("Unable to run 'sensors' command: %s", e, exc_info=True)
             # Do not return here, as we might still be able to read thermal zones
+            return None
+        return parse_sensors(sensors_output)
+
+    def _collect_sensors(self):
+        if self.sensors_source == 'sysfs':
+            # Reading a drive's hwmon chip is a command to the drive, so drivetemp and nvme chips follow the poll
+            # interval of their drive class and keep their last reading in between
+            previous = self.snapshot['sensors'] or {}
+            stale_chips = [chip for chip, chip_devices in self.sysfs_reader.drive_chips().items() if chip_devices and not any(self._hwmon_drive_due(device) for device in chip_devices)]
+            parsed_sensors = self.sysfs_reader.read_sensors(skip_chips=stale_chips)
+            parsed_sensors.update((chip, previous[chip]) for chip in stale_chips if chip in previous)
+            if any(parsed_sensors.values()):
+                return parsed_sensors
+            self.log.debug("No hwmon temperatures found in sysfs, falling back to 'sensors' command.")
+        return self._run_sensors_command()
+
+    def _hwmon_drive_due(self, device):
+        """
+        Returns whether the hwmon sensor of a drive may be read in this collection.
+        """
+        identity = self._devices.get(device)
+        if identity is None:
+            return True
+        # drivetemp may spin a sleeping disk up, leave those to `smartctl -n standby`
+        return identity['device_class'] in self._due_classes and not (self.skip_standby_drives and identity['device_class'] == 'hdd')
+
+    def _collect_drives(self):
+        if not self._due_classes:
+            return None
+        devices = self._devices
+        drives = {drive: temps_dict for drive, temps_dict in self.snapshot['drives'].items() if drive in devices}
+        due_devices = [drive for drive, identity in devices.items() if identity['device_class'] in self._due_classes]
+        if self.drive_hwmon:
+            hwmon_drives = self.sysfs_reader.read_drive_temperatures([drive for drive in due_devices if self._hwmon_drive_due(drive)])
+            read_at = time.time()
+            drives.update((drive, dict(hwmon_drives[drive], read_at=read_at)) for drive in due_devices if drive in hwmon_drives)
+            due_devices = [drive for drive in due_devices if drive not in hwmon_drives]
+        if not due_devices:
+            return drives
+        drives.update(get_drive_temperatures(
+            self.log,
+            devices=due_devices,
+            skip_standby=self.skip_standby_drives,
+            cache=self.drive_cache,
+            concurrency=self.smartctl_concurrency,
+            timeout=self.smartctl_timeout,
+            total_timeout=self.smartctl_total_timeout,
+            helper_socket=self.smartctl_helper_socket,
+            stats=self._stats,
+        ))
+        return drives
+
+    def collect(self):
+        """
+        Reads every source that is due and returns a snapshot of the readings along with when each source was read.
+
+        Sources that are not due keep their previous readings. Drives are scheduled per device class
+        (nvme, ssd, hdd) rather than as a whole.
+        """
+        snapshot = dict(self.snapshot, collected_at=dict(self.snapshot['collected_at']))
+        snapshot['stats'] = self._stats = new_collection_stats()
+        # Decided up front so drive hwmon chips in the sensors source follow the drive class intervals too
+        self._devices = self.device_index.refresh()
+        self.ceph_index.refresh(self._devices)
+        self._due_classes = {c for c in {identity['device_class'] for identity in self._devices.values()} if self.schedule.due(c)}
+        sources = [('sensors', self._collect_sensors), ('thermal_zones', self._read_all_thermal_zones)]
+        if self.ipmi_reader is not None:
+            sources.append(('ipmi', lambda: self.ipmi_reader.read(self._stats)))
+        for source, collect in sources:
+            if self.schedule.due(source):
+                started = time.monotonic()
+                snapshot[source] = collect()
+                self._stats['durations'][source] = time.monotonic() - started
+                snapshot['collected_at'][source] = time.time()
+        started = time.monotonic()
+        drives = self._collect_drives()
+        if drives is not None:
+            self._stats['durations']['drives'] = time.monotonic() - started
+            snapshot['drives'] = drives
+            snapshot['collected_at']['drives'] = time.time()
+        self.snapshot = snapshot
+        return snapshot
+
+    def _sample_history(self):
+        now = time.time()
+        # Drive sensors are left out: each drivetemp read is a command to the disk and would keep it spinning
+        for sensor_name, sensor_data_list in self._history_reader.read_sensors(exclude=DRIVE_HWMON_NAMES).items():
+            for sensor_data in sensor_data_list:
+                self.history.add(('sensor', sensor_name, sensor_data['component']), now, sensor_data['temp'])
+        for zone in self._history_reader.read_thermal_zones():
+            self.history.add(('zone', zone['zone_id']), now, zone['temp'])
+
+    def cancel(self):
+        # Descriptors still in use by a collector thread are closed by that thread once it exits
+        for thread, reader in ((self.collector, self.sysfs_reader), (self.history_sampler, self._history_reader)):
+            if thread is not None:
+                thread.stop(on_exit=reader.close)
+            else:
+                reader.close()
+        self.collector = None
+        self.history_sampler = None
+
+    def start_history_sampler(self):
+        if self.history_sample_interval and self.history_sampler is None:
+            # Has its own descriptors so sampling never races with collect() rediscovering sensors
+            self.history_sampler = BackgroundCollector(self._sample_history, self.history_sample_interval, self.log)
+            self.history_sampler.start()
+
+    def check(self, instance):
+        self.log.info("Starting temperatures check.") # Added for guaranteed visibility
+
+        self.start_history_sampler()
+
+        if self.snapshot_url:
+            snapshot = self._fetch_snapshot()
+            if snapshot is None:
+                return
+        elif not self.background_collection:
+            self.emit(self.collect())
+            return
         else:
-            self.log.info("Successfully ran 'sensors' command.")
-            parsed_sensors = parse_sensors(sensors_output)
-            self.log.info("Parsed sensors: %s", parsed_sensors)
+            if self.collector is None:
+                self.collector = BackgroundCollector(self.collect, self.collection_interval, self.log)
+                self.collector.start()
+            snapshot = self.collector.snapshot
+            if snapshot is None:
+                self.log.info("Background collector has not produced a snapshot yet.")
+                return
+        now = time.time()
+        for source, collected_at in snapshot['collected_at'].items():
+            self.gauge("custom.temperature.collector.freshness", now - collected_at, tags=[f"source:{source}"])
+        self.emit(snapshot)
+
+    def _fetch_snapshot(self):
+        """
+        Returns the exporter's latest snapshot, reusing the previous one when it answers 304 Not Modified.
+        """
+        request = urllib.request.Request(self.snapshot_url)
+        if self._remote_etag:
+            request.add_header('If-None-Match', self._remote_etag)
+        try:
+            with urllib.request.urlopen(request, timeout=self.snapshot_timeout) as response:
+                snapshot = json.load(response)
+                etag = response.headers.get('ETag')
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return self._remote_snapshot
+            self.log.warning("Unable to fetch the snapshot from %s: %s", self.snapshot_url, e)
+            return None
+        except (OSError, ValueError) as e:
+            self.log.warning("Unable to fetch the snapshot from %s: %s", self.snapshot_url, e)
+            return None
+        self._remote_snapshot, self._remote_etag = snapshot, etag
+        # Drive identity and Ceph tags are cheap to index locally and are not part of the snapshot
+        self.ceph_index.refresh(self.device_index.refresh())
+        return snapshot
+
+    def _sensor_plan(self, sensor_name, component):
+        """
+        Returns the (metric, reading key, tags) tuples to submit for one sensor component.
 
+        Plans are built the first time a component shows up and reused on every later interval.
+        """
+        plan = self._sensor_plans.get((sensor_name, component))
+        if plan is None:
+            tags = (f"sensor:{sensor_name}", f"component:{component}")
+            # k10temp components are covered by the socket rollups and NVMe sub-sensors by Composite
+            raw = self.raw_sensor_series or not ("k10temp" in sensor_name or ("nvme" in sensor_name and component != 'Composite'))
+            plan = [(metric, key, tags) for metric, key in SENSOR_METRICS] if raw else []
+            if "nvme" in sensor_name and raw:
+                nvme_tags = (f"drive:{sensor_name}",)
+                plan += [(metric, key, nvme_tags) for metric, key in NVME_METRICS]
+            if "k10temp-pci" in sensor_name and component == 'Tctl':
+                cpu_tags = (f"cpu:{sensor_name}-{component}",)
+                plan += [(metric, key, cpu_tags) for metric, key in CPU_METRICS]
+            plan = self._sensor_plans[(sensor_name, component)] = tuple(plan)
+        return plan
+
+    def emit(self, snapshot, gauge=None, all_thresholds=False):
+        """
+        Submits every metric of a snapshot through `gauge`, self.gauge unless given.
+
+        With aggregate_sensors, thresholds are only submitted when first seen or changed, unless
+        `all_thresholds` asks for every one (as a scrape does).
+        """
+        started = time.monotonic()
+        submit = gauge = gauge or self.gauge
+        reported_metrics = None
+        if self.log.isEnabledFor(logging.DEBUG):
+            reported_metrics = []
+
+            def gauge(metric, value, tags=None):
+                submit(metric, value, tags=tags)
+                reported_metrics.append({"metric": metric, "value": value, "tags": tags})
+
+        parsed_sensors = snapshot['sensors']
+        if parsed_sensors is not None:
+            self.log.debug("Parsed sensors: %s", parsed_sensors, extra=PAYLOAD)
+            skip_thresholds = self.aggregate_sensors and not all_thresholds
             for sensor_name, sensor_data_list in parsed_sensors.items():
-                self.log.info("Processing sensor: %s", sensor_name)
-                if 'k10temp-pci' in sensor_name:
-                    self.log.info("Processing k10temp-pci sensor for CPU temperature.")
                 for sensor_data in sensor_data_list:
-                    tags = [f"sensor:{sensor_name}", f"component:{sensor_data['component']}"]
-                    if 'temp' in sensor_data:
-                        self.gauge("custom.temperature.temp", sensor_data['temp'], tags=tags)
-                    if 'low' in sensor_data:
-                        self.gauge("custom.temperature.low", sensor_data['low'], tags=tags)
-                        reported_metrics.append({"metric": "custom.temperature.low", "value": sensor_data['low'], "tags": tags})
-                    if 'high' in sensor_data:
-                        self.gauge("custom.temperature.high", sensor_data['high'], tags=tags)
-                        reported_metrics.append({"metric": "custom.temperature.high", "value": sensor_data['high'], "tags": tags})
-                    if 'crit' in sensor_data:
-                        self.gauge("custom.temperature.crit", sensor_data['crit'], tags=tags)
-                        reported_metrics.append({"metric": "custom.temperature.crit", "value": sensor_data['crit'], "tags": tags})
-
-                    # If it's an NVMe drive, also report the special metrics
-                    self.log.info("Checking for NVMe sensor: %s", sensor_name)
-                    if "nvme" in sensor_name:
-                        self.log.info("NVMe sensor detected: %s", sensor_name)
-                        nvme_tags = [f"drive:{sensor_name}"]
-                        self.log.info("NVMe tags: %s", nvme_tags)
-                        self.log.info("NVMe sensor_data: %s", sensor_data)
-                        if 'temp' in sensor_data:
-                            self.gauge("custom.temperature.nvme.current", sensor_data['temp'], tags=nvme_tags)
-                            reported_metrics.append({"metric": "custom.temperature.nvme.current", "value": sensor_data['temp'], "tags": nvme_tags})
-                        if 'low' in sensor_data:
-                            self.gauge("custom.temperature.nvme.low", sensor_data['low'], tags=nvme_tags)
-                            reported_metrics.append({"metric": "custom.temperature.nvme.low", "value": sensor_data['low'], "tags": nvme_tags})
-                        if 'high' in sensor_data:
-                            self.gauge("custom.temperature.nvme.high", sensor_data['high'], tags=nvme_tags)
-                            reported_metrics.append({"metric": "custom.temperature.nvme.high", "value": sensor_data['high'], "tags": nvme_tags})
-                        if 'crit' in sensor_data:
-                            self.gauge("custom.temperature.nvme.crit", sensor_data['crit'], tags=nvme_tags)
-                            reported_metrics.append({"metric": "custom.temperature.nvme.crit", "value": sensor_data['crit'], "tags": nvme_tags})
-
-                    # If it's a CPU, also report the special metrics
-                    self.log.info("Checking for CPU sensor: %s", sensor_name)
-                    if "k10temp-pci" in sensor_name:
-                        self.log.info("k10temp-pci sensor detected: %s", sensor_name)
-                        # Only report Tctl metrics for CPU
-                        if sensor_data['component'] == 'Tctl':
-                            cpu_tags = [f"cpu:{sensor_name}-{sensor_data['component']}"]
-                            self.log.info("CPU tags: %s", cpu_tags)
-                            if 'temp' in sensor_data:
-                                self.gauge("custom.temperature.cpu", sensor_data['temp'], tags=cpu_tags)
-                                reported_metrics.append({"metric": "custom.temperature.cpu", "value": sensor_data['temp'], "tags": cpu_tags})
-
-        # Collect CPU temperatures from thermal zones
-        all_thermal_zones = self._read_all_thermal_zones()
-        for zone in all_thermal_zones:
-            self.gauge("custom.temperature.cpu", zone['temp'], tags=[f"cpu:{zone['zone_id']}"])
-            reported_metrics.append({"metric": "custom.temperature.cpu", "value": zone['temp'], "tags": [f"cpu:{zone['zone_id']}"]})
-
-        hdd_temps = get_drive_temperatures(self.log)
+                    for metric, key, tags in self._sensor_plan(sensor_name, sensor_data['component']):
+                        value = sensor_data.get(key)
+                        if value is None:
+                            continue
+                        if skip_thresholds and key in THRESHOLD_KEYS:
+                            if self._thresholds.get((metric, tags)) == value:
+                                continue
+                            self._thresholds[(metric, tags)] = value
+                        gauge(metric, value, tags=tags)
+            if self.aggregate_sensors:
+                self._emit_socket_rollups(gauge, parsed_sensors)
+
+        # Report CPU temperatures from thermal zones
+        for zone in snapshot['thermal_zones']:
+            tags = self._zone_tags.get(zone['zone_id'])
+            if tags is None:
+                tags = self._zone_tags[zone['zone_id']] = (f"cpu:{zone['zone_id']}",)
+            gauge("custom.temperature.cpu", zone['temp'], tags=tags)
+
+        hdd_temps = snapshot['drives']
+        timed_out = 0
+        now = time.time()
         for drive, temps_dict in hdd_temps.items():
-            tags = [f"drive:{drive}"]
-            if 'current' in temps_dict:
-                self.gauge("custom.temperature.hdd.current", temps_dict['current'], tags=tags)
-                reported_metrics.append({"metric": "custom.temperature.hdd.current", "value": temps_dict['current'], "tags": tags})
-            if 'crit' in temps_dict:
-                self.gauge("custom.temperature.hdd.crit", temps_dict['crit'], tags=tags)
-                reported_metrics.append({"metric": "custom.temperature.hdd.crit", "value": temps_dict['crit'], "tags": tags})
-
-        self.log.info("--- Metrics Exported Summary ---")
-        for metric_data in reported_metrics:
-            self.log.info(f"Metric: {metric_data['metric']}, Value: {metric_data['value']}, Tags: {metric_data['tags']}")
-        self.log.info("--- End of Metrics Summary ---")
+            identity_tags = self.device_index.tags(drive) + self.ceph_index.tags(drive)
+            tags = self._drive_tags.get(drive)
+            if tags is None or tags[1:] != identity_tags:
+                tags = self._drive_tags[drive] = (f"drive:{drive}",) + identity_tags
+            if temps_dict.get('timeout'):
+                timed_out += 1
+                gauge("custom.temperature.hdd.timeout", 1, tags=tags)
+                continue
+            if 'power_state' in temps_dict:
+                tags += (f"power_state:{temps_dict['power_state']}",)
+            # Readings are kept between polls of their class and while the drive sleeps
+            if 'read_at' in temps_dict:
+                gauge("custom.temperature.hdd.staleness", now - temps_dict['read_at'], tags=tags)
+            for metric, key in DRIVE_METRICS:
+                value = temps_dict.get(key)
+                if value is not None:
+                    gauge(metric, value, tags=tags)
+        submit("custom.temperature.hdd.timeouts", timed_out)
+
+        for kind, _, metric in IPMI_SENSOR_TYPES:
+            for name, value in (snapshot.get('ipmi') or {}).get(kind, {}).items():
+                tags = self._bmc_tags.get(name)
+                if tags is None:
+                    tags = self._bmc_tags[name] = (f"sensor:{name}",)
+                gauge(metric, value, tags=tags)
+
+        if self.history_sampler is not None:
+            self._emit_history(gauge)
+
+        if reported_metrics is not None:
+            self.log.debug("--- Metrics Exported Summary ---")
+            for metric_data in reported_metrics:
+                self.log.debug("Metric: %s, Value: %s, Tags: %s", metric_data['metric'], metric_data['value'], metric_data['tags'])
+            self.log.debug("--- End of Metrics Summary ---")
+
+        self._emit_stats(submit, snapshot.get('stats'), time.monotonic() - started)
+
+    def _emit_socket_rollups(self, gauge, parsed_sensors):
+        """
+        Reports the max and average of the CCD temperatures (Tccd*) of every CPU socket, or of its
+        Tdie/Tctl readings when no chip of that socket reports CCD temperatures.
+        """
+        chips = [sensor_name for sensor_name in parsed_sensors if sensor_name.startswith('k10temp-pci-')]
+        if any(chip not in self._chip_sockets for chip in chips):
+            self._chip_sockets = k10temp_sockets(self.log, chips, self.cpu_path)
+            self.log.info("Mapped k10temp chips to sockets: %s", self._chip_sockets)
+        # socket -> ([Tccd temperatures], [Tdie or Tctl temperature of each chip])
+        sockets = {}
+        for chip in chips:
+            temps = {sensor_data['component']: sensor_data['temp'] for sensor_data in parsed_sensors[chip] if sensor_data.get('temp') is not None}
+            ccds, dies = sockets.setdefault(self._chip_sockets[chip], ([], []))
+            ccds.extend(temp for component, temp in temps.items() if component.startswith('Tccd'))
+            dies.extend([temps[component] for component in ('Tdie', 'Tctl') if component in temps][:1])
+        for socket_id, (ccds, dies) in sockets.items():
+            temps = ccds or dies
+            if not temps:
+                continue
+            tags = self._socket_tags.get(socket_id)
+            if tags is None:
+                tags = self._socket_tags[socket_id] = (f"socket:{socket_id}",)
+            for metric, rollup in SOCKET_METRICS:
+                gauge(metric, rollup(temps), tags=tags)
+
+    def _emit_history(self, gauge):
+        """
+        Reports min/max/avg and the rate of change of every sampled sensor since the previous interval.
+        """
+        now = time.time()
+        for key, (low, high, average, slope) in self.history.summarize(self._history_emitted_at).items():
+            tags = self._history_tags.get(key)
+            if tags is None:
+                tags = self._history_tags[key] = (f"sensor:{key[1]}", f"component:{key[2]}") if key[0] == 'sensor' else (f"cpu:{key[1]}",)
+            gauge("custom.temperature.history.min", low, tags=tags)
+            gauge("custom.temperature.history.max", high, tags=tags)
+            gauge("custom.temperature.history.avg", average, tags=tags)
+            if slope is not None:
+                gauge("custom.temperature.history.slope", slope, tags=tags)
+        self._history_emitted_at = now
+
+    def _emit_stats(self, gauge, stats, emit_duration):
+        """
+        Reports how long each phase of the last collection took, how many processes it forked and how many errors it hit.
+        """
+        gauge("custom.temperature.check.duration", emit_duration, tags=["phase:emit"])
+        if stats is None:
+            return
+        for phase, duration in stats['durations'].items():
+            gauge("custom.temperature.check.duration", duration, tags=[f"phase:{phase}"])
+        for drive, duration in stats['drive_durations'].items():
+            gauge("custom.temperature.smartctl.duration", duration, tags=(f"drive:{drive}",) + self.device_index.tags(drive))
+        gauge("custom.temperature.check.forks", stats['forks'])
+        gauge("custom.temperature.check.errors", stats['errors'])
+
+
+def _openmetrics_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_openmetrics(check, snapshot):
+    """
+    Renders the metrics check.emit() would submit for a snapshot in the OpenMetrics text format.
+
+    custom.temperature.temp tagged sensor:nct6798-isa-0290 becomes
+    custom_temperature_temp{sensor="nct6798-isa-0290"}; repeated tag keys are joined with commas
+    and a series submitted twice keeps its last value.
+    """
+    families = {}
+
+    def gauge(metric, value, tags=None):
+        labels = {}
+        for tag in tags or ():
+            key, _, tag_value = tag.partition(':')
+            key = re.sub(r'[^a-zA-Z0-9_]', '_', key)
+            labels[key] = f"{labels[key]},{tag_value}" if key in labels else tag_value
+        series = ','.join(f'{key}="{_openmetrics_label(tag_value)}"' for key, tag_value in labels.items())
+        families.setdefault(re.sub(r'[^a-zA-Z0-9_]', '_', metric), {})[series] = value
+
+    check.emit(snapshot, gauge=gauge, all_thresholds=True)
+    lines = []
+    for name, samples in families.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{{{series}}} {value}" if series else f"{name} {value}" for series, value in samples.items())
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        rendered = self.server.rendered()
+        path = self.path.split('?', 1)[0]
+        if path not in ('/metrics', '/snapshot'):
+            self.send_error(404)
+            return
+        if rendered is None:
+            self.send_response(503)
+            self.send_header('Retry-After', str(self.server.collector.interval))
+            self.end_headers()
+            return
+        etag, content_type, body = rendered[path]
+        if etag in (tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.check.log.debug("%s - " + format, self.address_string(), *args)
+
+
+class SnapshotServer(ThreadingHTTPServer):
+    """
+    Serves a background collector's snapshots over HTTP: OpenMetrics on /metrics and JSON on /snapshot,
+    the latter for TemperaturesCheck instances configured with `snapshot_url`.
 
+    A snapshot is rendered once, by the first request that sees it, and every concurrent or later
+    request is answered from those bodies. Requests whose If-None-Match carries the current ETag get
+    an empty 304.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, check, interval):
+        super(SnapshotServer, self).__init__(address, SnapshotRequestHandler)
+        self.check = check
+        self.collector = BackgroundCollector(check.collect, interval, check.log)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._rendered = None
+
+    def rendered(self):
+        """
+        Returns {path: (etag, content type, body)} for the latest snapshot, or None before the first collection.
+        """
+        snapshot = self.collector.snapshot
+        with self._lock:
+            if snapshot is not None and snapshot is not self._snapshot:
+                rendered = {}
+                for path, content_type, body in (
+                    ('/metrics', 'application/openmetrics-text; version=1.0.0; charset=utf-8', render_openmetrics(self.check, snapshot)),
+                    ('/snapshot', 'application/json', json.dumps(snapshot)),
+                ):
+                    body = body.encode('utf-8')
+                    rendered[path] = (f'"{hashlib.sha1(body).hexdigest()[:16]}"', content_type, body)
+                self._snapshot, self._rendered = snapshot, rendered
+            return self._rendered
+
+
+def serve(argv=None):
+    """
+    Runs the collectors on their own schedule and serves their snapshot, see SnapshotServer.
+    """
+    parser = argparse.ArgumentParser(prog='temperatures.py serve', description="Serve temperature readings in OpenMetrics format.")
+    parser.add_argument('--config', default='/etc/datadog-agent/conf.d/temperatures.yaml', help="check configuration, its first instance is used")
+    parser.add_argument('--listen', default='127.0.0.1:9598', help="address and port to listen on")
+    parser.add_argument('--log-file', default='/tmp/temp_exporter.log', help="log file, kept apart from the check's own log_file")
+    args = parser.parse_args(argv)
+    try:
+        import yaml
+    except ImportError:
+        parser.error("PyYAML is needed to read the check configuration")
+    with open(args.config, 'r') as f:
+        # RotatingFileHandler is not safe across processes, so never share the agent's log file
+        instance = dict(yaml.safe_load(f)['instances'][0], background_collection=False, snapshot_url=None, log_file=args.log_file)
+    host, _, port = args.listen.rpartition(':')
+    check = TemperaturesCheck('temperatures', {}, {}, [instance])
+    server = SnapshotServer((host, int(port)), check, instance.get('collection_interval', 15))
+    server.collector.start()
+    check.start_history_sampler()
+    check.log.info("Serving temperatures on http://%s/metrics", args.listen)
+    try:
+        server.serve_forever()
+    finally:
+        server.collector.stop(on_exit=check.cancel)
+
+import shutil
+import tempfile
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+
+
+# `sensors` on a dual-socket EPYC host: eight k10temp data fabric nodes, two of them with CCD readings
+DUAL_SOCKET_SENSORS_OUTPUT = '''
+k10temp-pci-00f3
+Adapter: PCI adapter
+Tctl:         +44.5°C  
+
+k10temp-pci-00e3
+Adapter: PCI adapter
+Tctl:         +45.0°C  
+Tccd1:        +43.8°C  
+Tccd2:        +44.5°C  
+Tccd3:        +44.0°C  
+
+k10temp-pci-00d3
+Adapter: PCI adapter
+Tctl:         +50.2°C  
+
+k10temp-pci-00c3
+Adapter: PCI adapter
+Tctl:         +50.5°C  
+Tccd1:        +50.0°C  
+Tccd2:        +50.2°C  
+Tccd3:        +53.0°C  
+
+nvme-pci-4200
+Adapter: PCI adapter
+Composite:    +30.9°C  (low  = -273.1°C, high = +79.8°C)
+                       (crit = +82.8°C)
+Sensor 1:     +30.9°C  (low  = -273.1°C, high = +65261.8°C)
+Sensor 2:     +37.9°C  (low  = -273.1°C, high = +65261.8°C)
+
+k10temp-pci-00fb
+Adapter: PCI adapter
+Tctl:         +43.5°C  
+
+k10temp-pci-00eb
+Adapter: PCI adapter
+Tctl:         +43.2°C  
+
+k10temp-pci-00db
+Adapter: PCI adapter
+Tctl:         +50.0°C  
+
+k10temp-pci-00cb
+Adapter: PCI adapter
+Tctl:         +49.2°C  
+
+nvme-pci-4100
+Adapter: PCI adapter
+Composite:    +40.9°C  (low  = -273.1°C, high = +79.8°C)
+                       (crit = +82.8°C)
+Sensor 1:     +40.9°C  (low  = -273.1°C, high = +65261.8°C)
+Sensor 2:     +48.9°C  (low  = -273.1°C, high = +65261.8°C)
+'''
+
 
 class TestTemperatureExtraction(unittest.TestCase):
     def test_extract_temperature_from_smart_data_new_machine(self):
@@ -363,59 +1844,7 @@ class TestTemperatureExtraction(unittest.TestCase):
         self.assertIsNone(extracted_temp_none)
 
     def test_parse_sensors_with_k10temp(self):
-        sensors_output = '''
-k10temp-pci-00f3
-Adapter: PCI adapter
-Tctl:         +44.5°C  
-
-k10temp-pci-00e3
-Adapter: PCI adapter
-Tctl:         +45.0°C  
-Tccd1:        +43.8°C  
-Tccd2:        +44.5°C  
-Tccd3:        +44.0°C  
-
-k10temp-pci-00d3
-Adapter: PCI adapter
-Tctl:         +50.2°C  
-
-k10temp-pci-00c3
-Adapter: PCI adapter
-Tctl:         +50.5°C  
-Tccd1:        +50.0°C  
-Tccd2:        +50.2°C  
-Tccd3:        +53.0°C  
-
-nvme-pci-4200
-Adapter: PCI adapter
-Composite:    +30.9°C  (low  = -273.1°C, high = +79.8°C)
-                       (crit = +82.8°C)
-Sensor 1:     +30.9°C  (low  = -273.1°C, high = +65261.8°C)
-Sensor 2:     +37.9°C  (low  = -273.1°C, high = +65261.8°C)
-
-k10temp-pci-00fb
-Adapter: PCI adapter
-Tctl:         +43.5°C  
-
-k10temp-pci-00eb
-Adapter: PCI adapter
-Tctl:         +43.2°C  
-
-k10temp-pci-00db
-Adapter: PCI adapter
-Tctl:         +50.0°C  
-
-k10temp-pci-00cb
-Adapter: PCI adapter
-Tctl:         +49.2°C  
-
-nvme-pci-4100
-Adapter: PCI adapter
-Composite:    +40.9°C  (low  = -273.1°C, high = +79.8°C)
-                       (crit = +82.8°C)
-Sensor 1:     +40.9°C  (low  = -273.1°C, high = +65261.8°C)
-Sensor 2:     +48.9°C  (low  = -273.1°C, high = +65261.8°C)
-'''
+        sensors_output = DUAL_SOCKET_SENSORS_OUTPUT
         
         parsed_sensors = parse_sensors(sensors_output)
         
@@ -438,6 +1867,671 @@ Sensor 2:     +48.9°C  (low  = -273.1°C, high = +65261.8°C)
         self.assertEqual(parsed_sensors['nvme-pci-4200'][0]['low'], -273.1)
         self.assertEqual(parsed_sensors['nvme-pci-4200'][0]['high'], 79.8)
         self.assertEqual(parsed_sensors['nvme-pci-4200'][0]['crit'], 82.8)
+        self.assertEqual(parsed_sensors['nvme-pci-4200'][1], {'component': 'Sensor 1', 'temp': 30.9, 'low': -273.1, 'high': 65261.8})
+        self.assertEqual(parsed_sensors['k10temp-pci-00cb'], [{'component': 'Tctl', 'temp': 49.2}])
+
+    def test_parse_sensors_json(self):
+        sensors_output = '''{
+   "k10temp-pci-00c3":{
+      "Adapter": "PCI adapter",
+      "Tctl":{
+         "temp1_input": 50.500
+      },
+      "Tccd1":{
+         "temp3_input": 50.000
+      }
+   },
+   "nvme-pci-4200":{
+      "Adapter": "PCI adapter",
+      "Composite":{
+         "temp1_input": 30.850,
+         "temp1_max": 79.850,
+         "temp1_min": -273.150,
+         "temp1_crit": 82.850,
+         "temp1_alarm": 0.000
+      }
+   }
+}'''
+        parsed_sensors = parse_sensors_json(sensors_output)
+
+        self.assertEqual(parsed_sensors, {
+            'k10temp-pci-00c3': [{'component': 'Tctl', 'temp': 50.5}, {'component': 'Tccd1', 'temp': 50.0}],
+            'nvme-pci-4200': [{'component': 'Composite', 'temp': 30.85, 'low': -273.15, 'high': 79.85, 'crit': 82.85}],
+        })
+
+
+class TestSysfsSensorReader(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.hwmon_path = os.path.join(self.root, 'class', 'hwmon')
+        self.thermal_path = os.path.join(self.root, 'class', 'thermal')
+        self._make_device('pci', '0000:00:18.3')
+        self._make_device('pci', '0000:42:00.0')
+        self._make_hwmon('hwmon0', 'k10temp', 'pci', '0000:00:18.3', {
+            'temp1_input': '44500', 'temp1_label': 'Tctl',
+            'temp3_input': '43750', 'temp3_label': 'Tccd1',
+        })
+        self._make_hwmon('hwmon1', 'nvme', 'pci', '0000:42:00.0', {
+            'temp1_input': '30850', 'temp1_label': 'Composite',
+            'temp1_min': '-273150', 'temp1_max': '79850', 'temp1_crit': '82850',
+        })
+        zone = os.path.join(self.thermal_path, 'thermal_zone0')
+        os.makedirs(zone)
+        self._write(os.path.join(zone, 'temp'), '27800')
+
+    def _write(self, path, value):
+        with open(path, 'w') as f:
+            f.write(value + '\n')
+
+    def _make_device(self, subsystem, device):
+        os.makedirs(os.path.join(self.root, 'bus', subsystem), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'devices', device))
+        os.symlink(os.path.join(self.root, 'bus', subsystem), os.path.join(self.root, 'devices', device, 'subsystem'))
+
+    def _make_hwmon(self, hwmon, name, subsystem, device, attributes):
+        hwmon_dir = os.path.join(self.hwmon_path, hwmon)
+        os.makedirs(hwmon_dir)
+        os.symlink(os.path.join(self.root, 'devices', device), os.path.join(hwmon_dir, 'device'))
+        self._write(os.path.join(hwmon_dir, 'name'), name)
+        for attribute, value in attributes.items():
+            self._write(os.path.join(hwmon_dir, attribute), value)
+
+    def test_read_sensors_matches_parse_sensors_shape(self):
+        reader = SysfsSensorReader(Mock(), hwmon_path=self.hwmon_path, thermal_path=self.thermal_path)
+        self.addCleanup(reader.close)
+        parsed_sensors = reader.read_sensors()
+
+        self.assertEqual(parsed_sensors['k10temp-pci-00c3'], [
+            {'component': 'Tctl', 'temp': 44.5},
+            {'component': 'Tccd1', 'temp': 43.75},
+        ])
+        self.assertEqual(parsed_sensors['nvme-pci-4200'], [
+            {'component': 'Composite', 'temp': 30.85, 'low': -273.15, 'high': 79.85, 'crit': 82.85},
+        ])
+        self.assertEqual(reader.read_thermal_zones(), [{'zone_id': '0', 'temp': 27.8}])
+
+    def test_read_sensors_rereads_open_descriptors(self):
+        reader = SysfsSensorReader(Mock(), hwmon_path=self.hwmon_path, thermal_path=self.thermal_path)
+        self.addCleanup(reader.close)
+        reader.read_sensors()
+        with open(os.path.join(self.hwmon_path, 'hwmon0', 'temp1_input'), 'r+') as f:
+            f.write('51000\n')
+        self.assertEqual(reader.read_sensors()['k10temp-pci-00c3'][0]['temp'], 51.0)
+
+    def test_read_sensors_picks_up_chips_added_later(self):
+        reader = SysfsSensorReader(Mock(), hwmon_path=self.hwmon_path, thermal_path=self.thermal_path, rescan_interval=0)
+        self.addCleanup(reader.close)
+        self.assertEqual(sorted(reader.read_sensors()), ['k10temp-pci-00c3', 'nvme-pci-4200'])
+        self._make_device('pci', '0000:43:00.0')
+        self._make_hwmon('hwmon2', 'nvme', 'pci', '0000:43:00.0', {'temp1_input': '35850', 'temp1_label': 'Composite'})
+        self.assertEqual(reader.read_sensors()['nvme-pci-4300'], [{'component': 'Composite', 'temp': 35.85}])
+
+    def test_read_drive_temperatures_from_drivetemp_and_nvme(self):
+        self._make_device('scsi', 'host0/target0:0:1/0:0:1:0')
+        os.makedirs(os.path.join(self.root, 'devices', 'host0/target0:0:1/0:0:1:0', 'block', 'sdb'))
+        self._make_hwmon('hwmon2', 'drivetemp', 'scsi', 'host0/target0:0:1/0:0:1:0', {
+            'temp1_input': '36000', 'temp1_crit': '60000', 'temp1_lowest': '20000',
+        })
+        # Newer kernels register the nvme hwmon device on the nvme1 controller class device
+        self._make_device('pci', '0000:43:00.0')
+        self._make_device('nvme', '0000:43:00.0/nvme/nvme1')
+        os.symlink(os.path.join(self.root, 'devices', '0000:43:00.0'), os.path.join(self.root, 'devices', '0000:43:00.0/nvme/nvme1', 'device'))
+        os.makedirs(os.path.join(self.root, 'devices', '0000:43:00.0/nvme/nvme1', 'nvme1n1'))
+        self._make_hwmon('hwmon3', 'nvme', 'nvme', '0000:43:00.0/nvme/nvme1', {
+            'temp1_input': '40850', 'temp1_label': 'Composite', 'temp1_crit': '82850',
+        })
+        reader = SysfsSensorReader(Mock(), hwmon_path=self.hwmon_path, thermal_path=self.thermal_path)
+        self.addCleanup(reader.close)
+
+        self.assertIn('drivetemp-scsi-0-0', reader.read_sensors())
+        self.assertNotIn('drivetemp-scsi-0-0', reader.read_sensors(exclude=('drivetemp',)))
+        self.assertIn('nvme-pci-4300', reader.read_sensors())
+        self.assertEqual(reader.read_drive_temperatures(), {
+            'sdb': {'current': 36.0, 'crit': 60.0},
+            'nvme1n1': {'current': 40.85, 'crit': 82.85},
+        })
+        with patch.object(reader, '_read_millidegrees', wraps=reader._read_millidegrees) as read:
+            self.assertEqual(list(reader.read_drive_temperatures(['nvme1n1'])), ['nvme1n1'])
+        self.assertEqual(read.call_count, 2)
+
+
+    def test_drivetemp_is_not_read_between_hdd_polls(self):
+        self._make_device('scsi', 'host0/target0:0:1/0:0:1:0')
+        os.makedirs(os.path.join(self.root, 'devices', 'host0/target0:0:1/0:0:1:0', 'block', 'sdb'))
+        self._make_hwmon('hwmon2', 'drivetemp', 'scsi', 'host0/target0:0:1/0:0:1:0', {'temp1_input': '36000'})
+        os.makedirs(os.path.join(self.root, 'block'))
+        os.symlink(os.path.join(self.root, 'devices', 'host0/target0:0:1/0:0:1:0', 'block', 'sdb'), os.path.join(self.root, 'block', 'sdb'))
+        check = TemperaturesCheck('temperatures', {}, {}, [{
+            'log_file': os.path.join(self.root, 'temp_check.log'),
+            'hwmon_path': self.hwmon_path, 'thermal_path': self.thermal_path, 'sys_block_path': os.path.join(self.root, 'block'),
+            'poll_intervals': {'hdd': 300},
+        }])
+        self.addCleanup(check.cancel)
+
+        with patch.object(check.sysfs_reader, '_read_millidegrees', wraps=check.sysfs_reader._read_millidegrees) as read:
+            check.collect()
+            drivetemp_fd = check.sysfs_reader._drives['sdb'][1]
+            self.assertIn(drivetemp_fd, [c[0][0] for c in read.call_args_list])
+            read.reset_mock()
+            snapshot = check.collect()
+
+        self.assertNotIn(drivetemp_fd, [c[0][0] for c in read.call_args_list])
+        self.assertTrue(read.called)
+        self.assertEqual(snapshot['sensors']['drivetemp-scsi-0-0'], [{'component': 'temp1', 'temp': 36.0}])
+        self.assertEqual(snapshot['drives']['sdb']['current'], 36.0)
+
+
+class TestDriveTemperatures(unittest.TestCase):
+    def _popen(self, outputs):
+        def popen(command, **kwargs):
+            returncode, smart_data = outputs[command[-1]]
+            process = Mock(returncode=returncode)
+            process.communicate.return_value = (json.dumps(smart_data), '')
+            return process
+        return popen
+
+    def test_standby_drive_reuses_cached_reading(self):
+        standby = {"smartctl": {"exit_status": 2, "messages": [{"string": "Device is in STANDBY mode, exit(2)", "severity": "information"}]}}
+        awake = {"temperature": {"current": 38, "drive_trip": 60}}
+        cache = {'sdb': (time.time() - 120, {'current': 33})}
+        with patch('subprocess.Popen', side_effect=self._popen({'/dev/sda': (0, awake), '/dev/sdb': (2, standby), '/dev/sdc': (2, standby)})) as popen:
+            drive_temps = get_drive_temperatures(Mock(), devices=['sda', 'sdb', 'sdc'], skip_standby=True, cache=cache)
+
+        self.assertIn('-n', popen.call_args_list[0][0][0])
+        self.assertEqual(drive_temps['sda'], {'current': 38, 'crit': 60, 'read_at': cache['sda'][0]})
+        self.assertEqual(cache['sda'][1], {'current': 38, 'crit': 60})
+        self.assertEqual(drive_temps['sdb']['current'], 33)
+        self.assertEqual(drive_temps['sdb']['power_state'], 'standby')
+        self.assertEqual(drive_temps['sdb']['read_at'], cache['sdb'][0])
+        self.assertNotIn('sdc', drive_temps)
+
+    def test_hung_drive_is_reported_as_timeout(self):
+        script = os.path.join(tempfile.mkdtemp(), 'smartctl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(script))
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\ncase "$*" in *sdb*) exec sleep 30;; esac\necho \'{"temperature": {"current": 41}}\'\n')
+        os.chmod(script, 0o755)
+        real_popen = subprocess.Popen
+
+        def popen(command, **kwargs):
+            return real_popen([script] + command[2:], **kwargs)
+
+        started = time.monotonic()
+        stats = new_collection_stats()
+        with patch('subprocess.Popen', side_effect=popen):
+            drive_temps = get_drive_temperatures(Mock(), devices=['sda', 'sdb'], concurrency=2, timeout=0.5, stats=stats)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(drive_temps['sda']['current'], 41)
+        self.assertEqual(drive_temps['sdb'], {'timeout': True})
+        self.assertEqual((stats['forks'], stats['errors']), (2, 1))
+        self.assertGreaterEqual(stats['drive_durations']['sdb'], 0.5)
+
+
+    def test_helper_socket_answers_batched_request(self):
+        socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, socket_dir)
+        socket_path = os.path.join(socket_dir, 'helper.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(socket_path)
+        server.listen()
+        requests = []
+
+        def answer():
+            connection, _ = server.accept()
+            with connection:
+                requests.append(json.loads(connection.makefile().readline()))
+                connection.sendall(json.dumps({'drives': {
+                    'sda': {'returncode': 0, 'stdout': json.dumps({"temperature": {"current": 36}}), 'stderr': ''},
+                    'sdb': {'returncode': None},
+                }}).encode())
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        with patch('subprocess.Popen') as popen:
+            drive_temps = get_drive_temperatures(Mock(), devices=['sda', 'sdb'], helper_socket=socket_path)
+        thread.join()
+
+        popen.assert_not_called()
+        self.assertEqual(requests[0]['devices'], ['sda', 'sdb'])
+        self.assertEqual(drive_temps['sda']['current'], 36)
+        self.assertEqual(drive_temps['sdb'], {'timeout': True})
+
+
+class TestPayloadSampler(unittest.TestCase):
+    def test_only_payload_records_are_sampled(self):
+        sampler = PayloadSampler(0.25)
+        payload = logging.LogRecord(__name__, logging.DEBUG, __file__, 0, "Smart data: %s", (_LazyJson({}),), None)
+        payload.payload = True
+        message = logging.LogRecord(__name__, logging.DEBUG, __file__, 0, "Starting", (), None)
+        with patch('random.random', return_value=0.5):
+            self.assertFalse(sampler.filter(payload))
+            self.assertTrue(sampler.filter(message))
+        with patch('random.random', return_value=0.1):
+            self.assertTrue(sampler.filter(payload))
+
+
+class TestBlockDeviceIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.sys_block = os.path.join(self.root, 'block')
+        os.makedirs(self.sys_block)
+        os.makedirs(os.path.join(self.sys_block, 'loop0'))
+        self._make_disk('sdaa', 'devices/pci0000:40/0000:40:01.1/0000:41:00.0/host0/port-0:26/end_device-0:26/target0:0:26/0:0:26:0/block/sdaa', {
+            'wwid': 'naa.5000c500a1b2c3d4', 'model': 'ST16000NM001G   ',
+            'vpd_pg80': b'\x00\x80\x00\x08ZL2ABCDE',
+        })
+        self._make_disk('nvme0n1', 'devices/pci0000:40/0000:40:03.1/0000:42:00.0/nvme/nvme0/nvme0n1', {
+            'serial': 'S5GXNF0R123456', 'model': 'Samsung SSD 980 PRO 1TB',
+        })
+        slot_dir = os.path.join(self.root, 'devices/pci0000:40/0000:40:01.1/0000:41:00.0/host0/port-0:30/end_device-0:30/target0:0:30/0:0:30:0/enclosure/0:0:30:0/Slot 05')
+        os.makedirs(slot_dir)
+        with open(os.path.join(slot_dir, '..', 'id'), 'w') as f:
+            f.write('0x500605b0000272bf\n')
+        with open(os.path.join(slot_dir, 'slot'), 'w') as f:
+            f.write('5\n')
+        os.symlink(slot_dir, os.path.join(self.root, 'devices/pci0000:40/0000:40:01.1/0000:41:00.0/host0/port-0:26/end_device-0:26/target0:0:26/0:0:26:0/block/sdaa/device', 'enclosure_device:Slot 05'))
+
+    def _make_disk(self, name, target, device_attributes):
+        device_dir = os.path.join(self.root, target, 'device')
+        os.makedirs(device_dir)
+        for attribute, value in device_attributes.items():
+            with open(os.path.join(device_dir, attribute), 'wb' if isinstance(value, bytes) else 'w') as f:
+                f.write(value)
+        os.symlink(os.path.join('..', target), os.path.join(self.sys_block, name))
+
+    def test_refresh_indexes_disks_with_identity(self):
+        index = BlockDeviceIndex(Mock(), sys_block_path=self.sys_block)
+        devices = index.refresh()
+
+        self.assertEqual(sorted(devices), ['nvme0n1', 'sdaa'])
+        self.assertEqual(index.tags('sdaa'), ('wwn:naa.5000c500a1b2c3d4', 'serial:ZL2ABCDE', 'model:ST16000NM001G', 'enclosure_slot:0x500605b0000272bf/5', 'bus_address:0:0:26:0'))
+        self.assertEqual(index.tags('nvme0n1'), ('serial:S5GXNF0R123456', 'model:Samsung_SSD_980_PRO_1TB', 'bus_address:0000:42:00.0'))
+
+    def test_refresh_only_identifies_new_disks(self):
+        index = BlockDeviceIndex(Mock(), sys_block_path=self.sys_block)
+        index.refresh()
+        with patch.object(index, '_identify') as identify:
+            index.refresh()
+        identify.assert_not_called()
+
+
+class TestCephOsdIndex(unittest.TestCase):
+    LVS = json.dumps({'report': [{'lv': [
+        {'lv_tags': 'ceph.block_device=/dev/ceph-1a2b/osd-block-3c4d,ceph.crush_device_class=hdd,ceph.osd_id=3,ceph.type=block'},
+        {'lv_tags': 'ceph.crush_device_class=,ceph.osd_id=3,ceph.type=db'},
+    ]}]})
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        class_block = os.path.join(self.root, 'sys', 'class', 'block')
+        os.makedirs(class_block)
+        # LVM on dm-crypt on sdb3, DB on the first partition of nvme0n1
+        for name, partition_of, slaves in (('sdb3', 'sdb', ()), ('nvme0n1p1', 'nvme0n1', ()), ('dm-0', None, ('sdb3',)), ('dm-1', None, ('dm-0',))):
+            device_dir = os.path.join(self.root, 'sys', 'devices', partition_of or 'virtual', name)
+            os.makedirs(os.path.join(device_dir, 'slaves'))
+            if partition_of:
+                open(os.path.join(device_dir, 'partition'), 'w').close()
+            for slave in slaves:
+                os.symlink(os.path.join(class_block, slave), os.path.join(device_dir, 'slaves', slave))
+            os.symlink(device_dir, os.path.join(class_block, name))
+        self.osd_path = os.path.join(self.root, 'osd')
+        os.makedirs(os.path.join(self.osd_path, 'ceph-3'))
+        os.symlink(os.path.join(self.root, 'dev', 'dm-1'), os.path.join(self.osd_path, 'ceph-3', 'block'))
+        os.symlink(os.path.join(self.root, 'dev', 'nvme0n1p1'), os.path.join(self.osd_path, 'ceph-3', 'block.db'))
+        self.devices = {'sdb': {'link': '../devices/sdb', 'device_class': 'hdd'}, 'nvme0n1': {'link': '../devices/nvme0n1', 'device_class': 'nvme'}}
+
+    def _index(self):
+        return CephOsdIndex(Mock(), osd_path=self.osd_path, sys_block_path=os.path.join(self.root, 'sys', 'block'),
+                            index_path=os.path.join(self.root, 'cache', 'ceph-osd.json'), crush_host='pve1')
+
+    def test_refresh_maps_disks_to_osds_and_persists(self):
+        index = self._index()
+        with patch('subprocess.check_output', return_value=self.LVS) as lvs:
+            index.refresh(self.devices)
+            index.refresh(self.devices)
+        lvs.assert_called_once()
+        self.assertEqual(index.tags('sdb'), ('ceph_crush_host:pve1', 'ceph_osd:osd.3', 'ceph_device_class:hdd'))
+        self.assertEqual(index.tags('nvme0n1'), ('ceph_crush_host:pve1', 'ceph_osd:osd.3'))
+        self.assertEqual(index.tags('sda'), ())
+
+        # The persisted index is reused after a restart, and rebuilt once the layout changes
+        index = self._index()
+        with patch('subprocess.check_output', return_value=self.LVS) as lvs:
+            index.refresh(self.devices)
+            lvs.assert_not_called()
+            self.assertEqual(index.tags('sdb'), ('ceph_crush_host:pve1', 'ceph_osd:osd.3', 'ceph_device_class:hdd'))
+            os.remove(os.path.join(self.osd_path, 'ceph-3', 'block.db'))
+            index.refresh(self.devices)
+            lvs.assert_called_once()
+        self.assertEqual(index.tags('nvme0n1'), ())
+
+
+class TestBackgroundCollection(unittest.TestCase):
+    def test_check_emits_background_snapshot(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        check = TemperaturesCheck('temperatures', {}, {}, [{'log_file': os.path.join(log_dir, 'temp_check.log'), 'background_collection': True, 'collection_interval': 60}])
+        self.addCleanup(check.cancel)
+        snapshot = {
+            'sensors': {'k10temp-pci-00c3': [{'component': 'Tctl', 'temp': 44.5}]},
+            'thermal_zones': [],
+            'drives': {},
+            'collected_at': {'sensors': time.time(), 'thermal_zones': time.time(), 'drives': time.time()},
+        }
+        check.collect = Mock(return_value=snapshot)
+        check.gauge = Mock()
+
+        check.check({})
+        while check.collector.snapshot is None:
+            time.sleep(0.01)
+        check.gauge.reset_mock()
+        check.check({})
+
+        check.collect.assert_called_once_with()
+        check.gauge.assert_any_call("custom.temperature.cpu", 44.5, tags=("cpu:k10temp-pci-00c3-Tctl",))
+        freshness = [c for c in check.gauge.call_args_list if c[0][0] == "custom.temperature.collector.freshness"]
+        self.assertEqual(len(freshness), 3)
+
+    def test_stop_releases_resources_after_collection_in_progress(self):
+        events = []
+        collecting = threading.Event()
+
+        def collect():
+            collecting.set()
+            time.sleep(0.2)
+            events.append('collected')
+
+        collector = BackgroundCollector(collect, 60, Mock())
+        collector.start()
+        collecting.wait()
+        collector.stop(on_exit=lambda: events.append('closed'), timeout=0)
+        self.assertEqual(events, [])
+        collector.join()
+        self.assertEqual(events, ['collected', 'closed'])
+
+
+class TestEmit(unittest.TestCase):
+    def setUp(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.check = TemperaturesCheck('temperatures', {}, {}, [{'log_file': os.path.join(log_dir, 'temp_check.log')}])
+        self.addCleanup(self.check.cancel)
+        self.check.gauge = Mock()
+
+    def test_emit_submits_metrics_from_plan(self):
+        snapshot = {
+            'sensors': {
+                'k10temp-pci-00c3': [{'component': 'Tctl', 'temp': 44.5}, {'component': 'Tccd1', 'temp': 43.8}],
+                'nvme-pci-4200': [{'component': 'Composite', 'temp': 30.9, 'low': -273.1, 'high': 79.8, 'crit': 82.8}],
+            },
+            'thermal_zones': [{'zone_id': '0', 'temp': 27.8}],
+            'drives': {'sda': {'current': 36, 'crit': 60, 'read_at': time.time() - 300}, 'sdb': {'timeout': True}},
+        }
+        self.check.emit(snapshot)
+        self.check.emit(snapshot)
+
+        staleness = [c[0][1] for c in self.check.gauge.call_args_list if c[0][0] == 'custom.temperature.hdd.staleness']
+        self.assertEqual(len(staleness), 2)
+        self.assertTrue(300 <= staleness[0] <= staleness[1] < 310)
+        calls = {(c[0][0], c[0][1], c[1].get('tags')) for c in self.check.gauge.call_args_list if not c[0][0].startswith(('custom.temperature.check', 'custom.temperature.hdd.staleness'))}
+        self.assertEqual(calls, {
+            ('custom.temperature.temp', 44.5, ('sensor:k10temp-pci-00c3', 'component:Tctl')),
+            ('custom.temperature.cpu', 44.5, ('cpu:k10temp-pci-00c3-Tctl',)),
+            ('custom.temperature.temp', 43.8, ('sensor:k10temp-pci-00c3', 'component:Tccd1')),
+            ('custom.temperature.temp', 30.9, ('sensor:nvme-pci-4200', 'component:Composite')),
+            ('custom.temperature.low', -273.1, ('sensor:nvme-pci-4200', 'component:Composite')),
+            ('custom.temperature.high', 79.8, ('sensor:nvme-pci-4200', 'component:Composite')),
+            ('custom.temperature.crit', 82.8, ('sensor:nvme-pci-4200', 'component:Composite')),
+            ('custom.temperature.nvme.current', 30.9, ('drive:nvme-pci-4200',)),
+            ('custom.temperature.nvme.low', -273.1, ('drive:nvme-pci-4200',)),
+            ('custom.temperature.nvme.high', 79.8, ('drive:nvme-pci-4200',)),
+            ('custom.temperature.nvme.crit', 82.8, ('drive:nvme-pci-4200',)),
+            ('custom.temperature.cpu', 27.8, ('cpu:0',)),
+            ('custom.temperature.hdd.current', 36, ('drive:sda',)),
+            ('custom.temperature.hdd.crit', 60, ('drive:sda',)),
+            ('custom.temperature.hdd.timeout', 1, ('drive:sdb',)),
+            ('custom.temperature.hdd.timeouts', 1, None),
+        })
+        self.assertEqual(len(self.check._sensor_plans), 3)
+
+    def test_aggregate_rolls_up_sockets_and_sends_thresholds_on_change(self):
+        cpu_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cpu_path)
+        for cpu, package in enumerate((0, 0, 1, 1)):
+            os.makedirs(os.path.join(cpu_path, f"cpu{cpu}", 'topology'))
+            with open(os.path.join(cpu_path, f"cpu{cpu}", 'topology', 'physical_package_id'), 'w') as f:
+                f.write(f"{package}\n")
+        check = TemperaturesCheck('temperatures', {}, {}, [{'log_file': self.check.log_file_path, 'aggregate_sensors': True, 'cpu_path': cpu_path}])
+        self.addCleanup(check.cancel)
+        check.gauge = Mock()
+        nvme = [{'component': 'Composite', 'temp': 30.9, 'high': 79.8, 'crit': 82.8}, {'component': 'Sensor 1', 'temp': 30.9, 'high': 65261.8}]
+        snapshot = {
+            'sensors': {
+                'k10temp-pci-00cb': [{'component': 'Tctl', 'temp': 51.0}, {'component': 'Tccd1', 'temp': 48.0}, {'component': 'Tccd2', 'temp': 50.0}],
+                'k10temp-pci-00c3': [{'component': 'Tctl', 'temp': 44.5}, {'component': 'Tccd1', 'temp': 43.8}, {'component': 'Tccd2', 'temp': 40.2}],
+                'nvme-pci-4200': nvme,
+            },
+            'thermal_zones': [],
+            'drives': {},
+        }
+
+        check.emit(snapshot)
+        calls = {(c[0][0], c[0][1], c[1].get('tags')) for c in check.gauge.call_args_list if not c[0][0].startswith(('custom.temperature.check', 'custom.temperature.hdd'))}
+        self.assertEqual(calls, {
+            ('custom.temperature.socket.max', 43.8, ('socket:0',)),
+            ('custom.temperature.socket.avg', 42.0, ('socket:0',)),
+            ('custom.temperature.socket.max', 50.0, ('socket:1',)),
+            ('custom.temperature.socket.avg', 49.0, ('socket:1',)),
+            ('custom.temperature.cpu', 44.5, ('cpu:k10temp-pci-00c3-Tctl',)),
+            ('custom.temperature.cpu', 51.0, ('cpu:k10temp-pci-00cb-Tctl',)),
+            ('custom.temperature.temp', 30.9, ('sensor:nvme-pci-4200', 'component:Composite')),
+            ('custom.temperature.high', 79.8, ('sensor:nvme-pci-4200', 'component:Composite')),
+            ('custom.temperature.crit', 82.8, ('sensor:nvme-pci-4200', 'component:Composite')),
+            ('custom.temperature.nvme.current', 30.9, ('drive:nvme-pci-4200',)),
+            ('custom.temperature.nvme.high', 79.8, ('drive:nvme-pci-4200',)),
+            ('custom.temperature.nvme.crit', 82.8, ('drive:nvme-pci-4200',)),
+        })
+
+        check.gauge.reset_mock()
+        nvme[0]['crit'] = 84.8
+        check.emit(snapshot)
+        metrics = [c[0][0] for c in check.gauge.call_args_list]
+        self.assertNotIn('custom.temperature.high', metrics)
+        self.assertEqual(metrics.count('custom.temperature.crit'), 1)
+        self.assertEqual(metrics.count('custom.temperature.nvme.crit'), 1)
+
+    def test_aggregate_falls_back_to_tctl_per_socket(self):
+        cpu_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cpu_path)
+        for cpu, package in enumerate((0, 0, 1, 1)):
+            os.makedirs(os.path.join(cpu_path, f"cpu{cpu}", 'topology'))
+            with open(os.path.join(cpu_path, f"cpu{cpu}", 'topology', 'physical_package_id'), 'w') as f:
+                f.write(f"{package}\n")
+        check = TemperaturesCheck('temperatures', {}, {}, [{'log_file': self.check.log_file_path, 'aggregate_sensors': True, 'cpu_path': cpu_path}])
+        self.addCleanup(check.cancel)
+        check.gauge = Mock()
+        sensors = parse_sensors(DUAL_SOCKET_SENSORS_OUTPUT)
+
+        # 00c3..00db are socket 0 and 00e3..00fb socket 1; only 00c3 and 00e3 report CCDs, the other Tctl are left out
+        check.emit({'sensors': sensors, 'thermal_zones': [], 'drives': {}})
+        rollups = {(c[0][0], c[1]['tags']): c[0][1] for c in check.gauge.call_args_list if c[0][0].startswith('custom.temperature.socket')}
+        self.assertEqual(set(rollups), {(metric, (f"socket:{socket_id}",)) for metric, _ in SOCKET_METRICS for socket_id in (0, 1)})
+        self.assertEqual(rollups[('custom.temperature.socket.max', ('socket:0',))], 53.0)
+        self.assertAlmostEqual(rollups[('custom.temperature.socket.avg', ('socket:0',))], (50.0 + 50.2 + 53.0) / 3)
+        self.assertEqual(rollups[('custom.temperature.socket.max', ('socket:1',))], 44.5)
+        self.assertAlmostEqual(rollups[('custom.temperature.socket.avg', ('socket:1',))], (43.8 + 44.5 + 44.0) / 3)
+
+        # Without CCD readings anywhere in a socket, its Tctl readings are used
+        check.gauge.reset_mock()
+        for chip in ('k10temp-pci-00c3', 'k10temp-pci-00e3'):
+            sensors[chip] = sensors[chip][:1]
+        check.emit({'sensors': sensors, 'thermal_zones': [], 'drives': {}})
+        rollups = {(c[0][0], c[1]['tags']): c[0][1] for c in check.gauge.call_args_list if c[0][0].startswith('custom.temperature.socket')}
+        self.assertEqual(rollups[('custom.temperature.socket.max', ('socket:0',))], 50.5)
+        self.assertAlmostEqual(rollups[('custom.temperature.socket.avg', ('socket:1',))], (45.0 + 43.2 + 44.5 + 43.5) / 4)
+
+    def test_uneven_socket_split_is_logged(self):
+        log = Mock()
+        with patch('glob.glob', return_value=['cpu0', 'cpu1']), patch(__name__ + '._read_sysfs_attribute', side_effect=['0', '1']):
+            sockets = k10temp_sockets(log, ['k10temp-pci-00c3', 'k10temp-pci-00cb', 'k10temp-pci-00d3'])
+        self.assertEqual(sockets, {'k10temp-pci-00c3': 0, 'k10temp-pci-00cb': 0, 'k10temp-pci-00d3': 1})
+        log.warning.assert_called_once()
+
+
+class TestSnapshotServer(unittest.TestCase):
+    def setUp(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.instance = {'log_file': os.path.join(log_dir, 'temp_check.log')}
+        check = TemperaturesCheck('temperatures', {}, {}, [self.instance])
+        self.addCleanup(check.cancel)
+        check.collect = Mock(return_value={
+            'sensors': {'nct6798-isa-0290': [{'component': 'SYSTIN', 'temp': 31.0}]},
+            'thermal_zones': [],
+            'drives': {'sda': {'current': 36, 'crit': 60}},
+            'collected_at': {'sensors': time.time(), 'thermal_zones': time.time(), 'drives': time.time()},
+        })
+        self.server = SnapshotServer(('127.0.0.1', 0), check, 60)
+        self.server.collector.start()
+        self.addCleanup(self.server.collector.stop)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        while self.server.collector.snapshot is None:
+            time.sleep(0.01)
+
+    def test_metrics_are_served_once_per_snapshot(self):
+        with urllib.request.urlopen(self.url + '/metrics') as response:
+            body = response.read().decode('utf-8')
+            etag = response.headers['ETag']
+        self.assertIn('# TYPE custom_temperature_temp gauge\ncustom_temperature_temp{sensor="nct6798-isa-0290",component="SYSTIN"} 31.0\n', body)
+        self.assertIn('custom_temperature_hdd_current{drive="sda"} 36\n', body)
+        self.assertTrue(body.endswith('# EOF\n'))
+
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(urllib.request.Request(self.url + '/metrics', headers={'If-None-Match': etag}))
+        self.assertEqual(raised.exception.code, 304)
+
+    def test_check_emits_served_snapshot(self):
+        check = TemperaturesCheck('temperatures', {}, {}, [dict(self.instance, snapshot_url=self.url + '/snapshot')])
+        self.addCleanup(check.cancel)
+        check.collect = Mock()
+        check.gauge = Mock()
+        check.check({})
+        check.check({})
+
+        check.collect.assert_not_called()
+        self.assertEqual(check._remote_snapshot['drives'], {'sda': {'current': 36, 'crit': 60}})
+        self.assertEqual([c[0][1] for c in check.gauge.call_args_list if c[0][0] == 'custom.temperature.temp'], [31.0, 31.0])
+
+
+class TestSensorHistory(unittest.TestCase):
+    def test_summarize_reports_window_min_max_avg_and_slope(self):
+        history = SensorHistory(4)
+        for second, value in enumerate([40.0, 41.0, 42.0, 43.0, 44.0, 45.0]):
+            history.add(('sensor', 'k10temp-pci-00c3', 'Tctl'), 1000 + second, value)
+        history.add(('zone', '0'), 1005, 27.8)
+
+        summaries = history.summarize(1002)
+
+        # Only the four newest samples are kept, and only those after `since` count
+        low, high, average, slope = summaries[('sensor', 'k10temp-pci-00c3', 'Tctl')]
+        self.assertEqual((low, high, average), (43.0, 45.0, 44.0))
+        self.assertAlmostEqual(slope, 60.0)
+        self.assertEqual(summaries[('zone', '0')], (27.8, 27.8, 27.8, None))
+        self.assertEqual(history.summarize(1005), {})
+
+    def test_sampler_leaves_drive_sensors_alone(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        check = TemperaturesCheck('temperatures', {}, {}, [{'log_file': os.path.join(log_dir, 'temp_check.log')}])
+        self.addCleanup(check.cancel)
+        with patch.object(check._history_reader, 'read_sensors', return_value={}) as read_sensors:
+            check._sample_history()
+        read_sensors.assert_called_once_with(exclude=DRIVE_HWMON_NAMES)
+
+
+class TestIpmiSensorReader(unittest.TestCase):
+    IPMITOOL = '''#!/bin/sh
+echo "$*" >> "$(dirname "$0")/calls"
+case "$*" in
+"sdr info") printf 'SDR Version                         : 0x51\\nMost recent Addition                : 10/18/2026 09:12:03\\nMost recent Erase                   : 01/01/2026 00:00:00\\n';;
+"sdr dump "*) echo dump > "$3";;
+*"sdr type Temperature") printf 'CPU1 Temp        | 01h | ok  |  3.1 | 45 degrees C\\nVRMCpu1 Temp     | 10h | ok  |  3.1 | 38 degrees C\\n';;
+*"sdr type Fan") printf 'FAN1             | 41h | ok  | 29.1 | 2100 RPM\\nFANA             | 45h | ns  | 29.1 | No Reading\\n';;
+*"sdr type Voltage") printf '12V              | 30h | ok  |  7.17 | 12.06 Volts\\n';;
+*"sensor reading"*) printf 'CPU1 Temp        | 45\\nVRMCpu1 Temp     | 38\\nFAN1             | 2100\\nFANA             | \\n12V              | 12.064\\n';;
+esac
+'''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.ipmitool = os.path.join(self.root, 'ipmitool')
+        with open(self.ipmitool, 'w') as f:
+            f.write(self.IPMITOOL)
+        os.chmod(self.ipmitool, 0o755)
+
+    def _calls(self):
+        with open(os.path.join(self.root, 'calls')) as f:
+            calls = f.read().splitlines()
+        os.remove(os.path.join(self.root, 'calls'))
+        return calls
+
+    def test_read_dumps_sdr_once_and_reads_in_one_batch(self):
+        cache_dir = os.path.join(self.root, 'cache')
+        reader = IpmiSensorReader(Mock(), ipmitool=self.ipmitool, cache_dir=cache_dir)
+        stats = new_collection_stats()
+
+        self.assertEqual(reader.read(stats), {
+            'temperature': {'CPU1 Temp': 45.0, 'VRMCpu1 Temp': 38.0},
+            'fan': {'FAN1': 2100.0},
+            'voltage': {'12V': 12.064},
+        })
+        self.assertEqual(len(self._calls()), 6)
+
+        reader.read(stats)
+        self.assertEqual(self._calls(), [f"-S {cache_dir}/sdr.bin sensor reading CPU1 Temp VRMCpu1 Temp FAN1 FANA 12V"])
+
+        # A restarted agent finds the dump on disk and only checks the SDR timestamp
+        IpmiSensorReader(Mock(), ipmitool=self.ipmitool, cache_dir=cache_dir).read(stats)
+        self.assertEqual(len(self._calls()), 2)
+        self.assertEqual(stats['forks'], 9)
+
+
+class TestPollSchedule(unittest.TestCase):
+    def test_due_respects_interval(self):
+        schedule = PollSchedule({'hdd': 300, 'nvme': 60})
+        with patch('time.monotonic', return_value=1000):
+            self.assertTrue(schedule.due('hdd'))
+            self.assertTrue(schedule.due('nvme'))
+            self.assertTrue(schedule.due('sensors'))
+            self.assertTrue(schedule.due('sensors'))
+            self.assertFalse(schedule.due('hdd'))
+        with patch('time.monotonic', return_value=1100):
+            self.assertFalse(schedule.due('hdd'))
+            self.assertTrue(schedule.due('nvme'))
+        with patch('time.monotonic', return_value=1300):
+            self.assertTrue(schedule.due('hdd'))
+
+    def test_due_applies_jitter(self):
+        schedule = PollSchedule({'hdd': 100}, jitter=0.2)
+        with patch('time.monotonic', return_value=0), patch('random.uniform', return_value=0.2):
+            schedule.due('hdd')
+        with patch('time.monotonic', return_value=110):
+            self.assertFalse(schedule.due('hdd'))
+        with patch('time.monotonic', return_value=120):
+            self.assertTrue(schedule.due('hdd'))
+
 
 if __name__ == '__main__':
-    unittest.main()
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2:])
+    else:
+        unittest.main()
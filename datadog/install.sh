@@ -1,19 +1,39 @@
 #!/bin/bash
 
+# Usage: ./install.sh [--with-ipmi]
+#   --with-ipmi  let the dd-agent group read and write /dev/ipmi* for the check's IPMI source (ipmi: true).
+#                This is full access to the BMC, including power control and BMC user management.
+WITH_IPMI=0
+for arg in "$@"; do
+    case "${arg}" in
+        --with-ipmi) WITH_IPMI=1 ;;
+        *) echo "Unknown option: ${arg}" >&2; exit 1 ;;
+    esac
+done
+
 # Define source files (relative to script location)
 LOCAL_CHECK_FILE="checks.d/temperatures.py"
 LOCAL_CONF_FILE="conf.d/temperatures.yaml"
 LOCAL_SUDOERS_FILE="sudoers.d/dd-temperatures-smartctl"
+LOCAL_HELPER_FILE="bin/dd-temperatures-helper"
+LOCAL_HELPER_UNITS="systemd/dd-temperatures-helper.socket systemd/dd-temperatures-helper.service systemd/dd-temperatures-exporter.service"
+LOCAL_UDEV_FILE="udev/99-dd-temperatures-ipmi.rules"
 
 # Define destination paths on the local machine
 DEST_CHECK_DIR="/etc/datadog-agent/checks.d/"
 DEST_CONF_DIR="/etc/datadog-agent/conf.d/"
 DEST_SUDOERS_DIR="/etc/sudoers.d/"
+DEST_HELPER_DIR="/usr/local/sbin/"
+DEST_SYSTEMD_DIR="/etc/systemd/system/"
+DEST_UDEV_DIR="/etc/udev/rules.d/"
 
 # Ensure destination directories exist
 sudo mkdir -p "${DEST_CHECK_DIR}"
 sudo mkdir -p "${DEST_CONF_DIR}"
 sudo mkdir -p "${DEST_SUDOERS_DIR}"
+sudo mkdir -p "${DEST_HELPER_DIR}"
+sudo mkdir -p "${DEST_SYSTEMD_DIR}"
+sudo mkdir -p "${DEST_UDEV_DIR}"
 
 # Copy check file
 echo "Copying ${LOCAL_CHECK_FILE} to ${DEST_CHECK_DIR}"
@@ -27,6 +47,32 @@ sudo cp "${LOCAL_CONF_FILE}" "${DEST_CONF_DIR}"
 echo "Copying ${LOCAL_SUDOERS_FILE} to ${DEST_SUDOERS_DIR}"
 sudo cp "${LOCAL_SUDOERS_FILE}" "${DEST_SUDOERS_DIR}"
 
+# Install the privileged smartctl helper and its socket
+echo "Copying ${LOCAL_HELPER_FILE} to ${DEST_HELPER_DIR}"
+sudo install -m 0755 "${LOCAL_HELPER_FILE}" "${DEST_HELPER_DIR}"
+echo "Copying ${LOCAL_HELPER_UNITS} to ${DEST_SYSTEMD_DIR}"
+sudo cp ${LOCAL_HELPER_UNITS} "${DEST_SYSTEMD_DIR}"
+sudo systemctl daemon-reload
+sudo systemctl enable --now dd-temperatures-helper.socket
+# Pick up a new helper version on the next request
+sudo systemctl try-restart dd-temperatures-helper.service
+# The OpenMetrics exporter is opt-in (systemctl enable --now dd-temperatures-exporter), restart it if enabled
+sudo systemctl try-restart dd-temperatures-exporter.service
+
+# Only give the agent access to /dev/ipmi* when asked to, and take it back otherwise
+DEST_UDEV_FILE="${DEST_UDEV_DIR}$(basename "${LOCAL_UDEV_FILE}")"
+if [ "${WITH_IPMI}" = 1 ]; then
+    echo "Copying ${LOCAL_UDEV_FILE} to ${DEST_UDEV_DIR}"
+    sudo cp "${LOCAL_UDEV_FILE}" "${DEST_UDEV_DIR}"
+    sudo udevadm control --reload-rules
+    sudo udevadm trigger --subsystem-match=ipmi
+elif [ -e "${DEST_UDEV_FILE}" ]; then
+    echo "Removing ${DEST_UDEV_FILE}"
+    sudo rm -f "${DEST_UDEV_FILE}"
+    sudo udevadm control --reload-rules
+    sudo udevadm trigger --subsystem-match=ipmi
+fi
+
 # Restart Datadog agent
 echo "Restarting Datadog agent"
 sudo systemctl restart datadog-agent